@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+import redis
+
+from metrics import metrics as default_metrics
+
+DEFAULT_MAX_BUCKETS = 100000
+DEFAULT_QUEUE_TIMEOUT = 0.05   # in seconds
+# Window of shared rate limiter
+RATE_WINDOW = 1   # in seconds
+# Socket timeout of Redis used by shared rate limiter
+RATE_LIMIT_REDIS_TIMEOUT = 0.05   # in seconds
+
+
+class TokenBucket(object):
+    """ `rate` tokens per second are added to the bucket up to `burst` tokens """
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated_at = clock()
+
+    def consume(self, tokens=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class LocalRateLimiter(object):
+    """
+    Token bucket per key kept in the process.
+    Only `max_buckets` recently used buckets are kept.
+    """
+    def __init__(self, rate, burst, max_buckets=DEFAULT_MAX_BUCKETS, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, self.clock)
+                if len(self.buckets) >= self.max_buckets:
+                    self.buckets.popitem(last=False)
+            self.buckets[key] = bucket
+            return bucket.consume()
+
+
+def rate_limit_store_config(config):
+    """
+    Config of store for `RedisRateLimiter` which fails fast when Redis
+    is down instead of making connection attempts on the request thread
+    """
+    return dict(config, ATTEMPTS=0, SLEEP_TIMEOUT=0, SOCKET_TIMEOUT=RATE_LIMIT_REDIS_TIMEOUT,
+                TRACK_HOT_KEYS=False)
+
+
+class RedisRateLimiter(object):
+    """
+    Rate limiter shared by all workers via Redis.
+    Token bucket needs atomic read-modify-write in Redis, so it's
+    approximated with counters of `RATE_WINDOW` windows which allow
+    `rate` requests per second plus `burst`. If Redis is down
+    requests are allowed.
+    """
+    def __init__(self, store, rate, burst, clock=time.time):
+        self.store = store
+        self.limit = rate * RATE_WINDOW + burst
+        self.clock = clock
+
+    def allow(self, key):
+        window = int(self.clock() // RATE_WINDOW)
+        try:
+            count = self.store.incr("rl:%s:%d" % (key, window), RATE_WINDOW * 2)
+        except (redis.ConnectionError, redis.TimeoutError):
+            logging.error("Redis is down, rate limit isn't checked")
+            return True
+        return count <= self.limit
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ConcurrencyLimiter(object):
+    """
+    Allows `max_active` requests at once, up to `max_queue`
+    requests wait for a free slot not longer than `queue_timeout`.
+    """
+    def __init__(self, max_active, max_queue=0, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ Take a slot and return time in queue or raise `Overloaded` """
+        started = time.time()
+        with self.condition:
+            if self.active < self.max_active:
+                self.active += 1
+                return 0
+            if self.waiting >= self.max_queue:
+                raise Overloaded("Queue is full")
+            self.waiting += 1
+            try:
+                while self.active >= self.max_active:
+                    remaining = started + self.queue_timeout - time.time()
+                    if remaining <= 0:
+                        raise Overloaded("Queue timeout")
+                    self.condition.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+        return time.time() - started
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class AdmissionController(object):
+    """
+    Decides if request is handled. Requests of a key (e.g. login)
+    over its rate are rejected with `rate_limited_code`, requests over
+    concurrency limit with `overloaded_code`. Both limits are optional.
+    """
+    def __init__(self, rate_limiter=None, concurrency=None,
+                 rate_limited_code=429, overloaded_code=503, metrics=default_metrics):
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.rate_limited_code = rate_limited_code
+        self.overloaded_code = overloaded_code
+        self.metrics = metrics
+
+    def admit(self, key=None):
+        """
+        Return None if request with rate limit key is admitted otherwise code
+        of the error. The key is needed only if there is a rate limiter
+        """
+        if self.rate_limiter is not None and not self.rate_limiter.allow(key):
+            self.metrics.inc("admission.shed.rate_limited")
+            return self.rate_limited_code
+        if self.concurrency is not None:
+            try:
+                queued = self.concurrency.acquire()
+            except Overloaded:
+                self.metrics.inc("admission.shed.overloaded")
+                return self.overloaded_code
+            self.metrics.observe("admission.queue_time_ms", queued * 1000)
+        self.metrics.inc("admission.admitted")
+        return None
+
+    def release(self):
+        if self.concurrency is not None:
+            self.concurrency.release()
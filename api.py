@@ -5,31 +5,54 @@ import json
 import datetime
 import logging
 import hashlib
+import os
+import signal
+import socket
+import threading
+import time
 import uuid
+# strptime imports this module lazily and it isn't thread-safe
+import _strptime  # noqa
 
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 from collections import Sequence, Sized
 
-from scoring import get_score, get_interests
-from store import RedisCache, REDIS_CONFIG
+from admission import (AdmissionController, ConcurrencyLimiter, LocalRateLimiter, RedisRateLimiter,
+                       rate_limit_store_config)
+from compression import choose_encoding, write_compressed, DEFAULT_MIN_SIZE, DEFAULT_LEVEL
+from dates import AgeCutoff, parse_date
+from hotkeys import hot_keys, hot_callers
+from metrics import metrics
+from scoring import get_score, get_raw_interests_many, decode_interests, interests_etag
+from store import RedisCache, REDIS_CONFIG, DeadlineExceeded
+from shmcache import SharedMemoryCache, TieredCache
+from warmup import warm_up, SnapshotWriter, DEFAULT_SCAN_LIMIT
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
 ADMIN_SCORE = 42
 OK = 200
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
 UNKNOWN = 0
 MALE = 1
@@ -40,6 +63,8 @@ GENDERS = {
     FEMALE: "female",
 }
 LIMIT_YEARS = 70
+# Time for requests in progress when the worker is stopped
+DRAIN_TIMEOUT = 30   # in seconds
 PHONE_LENGTH = 11
 
 
@@ -117,18 +142,19 @@ class DateField(BaseField):
     def __set__(self, instance, value):
         if isinstance(value, basestring):
             try:
-                value = datetime.datetime.strptime(value, "%d.%m.%Y")
+                value = parse_date(value)
             except ValueError:
                 raise ValidationError("Invalid field datetime format")
         super(DateField, self).__set__(instance, value)
 
 
 class BirthDayField(DateField):
+    age_cutoff = AgeCutoff(LIMIT_YEARS)
+
     def __set__(self, instance, value):
         super(BirthDayField, self).__set__(instance, value)
         if isinstance(instance.__dict__[self.field_name], datetime.datetime):
-            if instance.__dict__[self.field_name] < (datetime.datetime.today() -
-                             datetime.timedelta(days=365 * LIMIT_YEARS)):
+            if self.age_cutoff.is_too_old(instance.__dict__[self.field_name]):
                 raise ValidationError("The field cannot be "
                                       "older than %d years" % LIMIT_YEARS)
 
@@ -246,7 +272,8 @@ class OnlineScoreHandler(RequestHandler):
                 birthday=arguments.birthday,
                 gender=arguments.gender,
                 first_name=arguments.first_name,
-                last_name=arguments.last_name
+                last_name=arguments.last_name,
+                deadline=ctx.get("deadline")
             )
         ctx["has"] = [field_name for field_name, field_value in arguments.fields.items()
                       if getattr(arguments, field_name) is not None]
@@ -258,8 +285,12 @@ class ClientsInterestsHandler(RequestHandler):
 
     def get_result(self, request, arguments, ctx, store):
         ctx["nclients"] = len(arguments.client_ids)
-        return {client_id: get_interests(store, client_id)
-                for client_id in arguments.client_ids}, OK
+        values = get_raw_interests_many(store, arguments.client_ids, deadline=ctx.get("deadline"))
+        ctx["etag"] = interests_etag(arguments.client_ids, values)
+        if_none_match = ctx.get("if_none_match", ())
+        if ctx["etag"] in if_none_match or "*" in if_none_match:
+            return None, NOT_MODIFIED
+        return dict(zip(arguments.client_ids, decode_interests(values))), OK
 
 
 class MethodRequest(BaseRequest):
@@ -274,9 +305,13 @@ class MethodRequest(BaseRequest):
         return self.login == ADMIN_LOGIN
 
 
+def admin_token():
+    return hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+
+
 def check_auth(request):
     if request.is_admin:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        digest = admin_token()
     else:
         digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
     if digest == request.token:
@@ -284,18 +319,50 @@ def check_auth(request):
     return False
 
 
+def caller_key(request, authorized, client_address):
+    """
+    Authorized requests are identified by account and login, the others by
+    client address, so nobody else can pass for the login
+    """
+    if authorized:
+        return "%s/%s" % (request.account, request.login)
+    return "ip:%s" % client_address[0]
+
+
+def authorize(body):
+    """ Return MethodRequest of the body and True if it's valid and authorized """
+    request = MethodRequest(**body)
+    try:
+        return request, request.is_valid() and check_auth(request)
+    except TypeError:
+        # account is None
+        return request, False
+
+
+def parse_etags(header):
+    """ Return list of ETags from If-None-Match header, weak ETags are compared as strong """
+    if not header:
+        return []
+    etags = [etag.strip() for etag in header.split(",")]
+    return [etag[2:] if etag.startswith("W/") else etag for etag in etags if etag]
+
+
 def method_handler(request, ctx, store):
     methods = {
         "online_score": OnlineScoreHandler,
         "clients_interests": ClientsInterestsHandler
     }
 
-    request_obj = MethodRequest(**request["body"])
+    ctx["if_none_match"] = parse_etags((request.get("headers") or {}).get("If-None-Match"))
+    # the request is already authorized if admission control needed it
+    request_obj, authorized = ctx.pop("auth", None) or authorize(request["body"])
     if not request_obj.is_valid():
+        hot_callers.add(caller_key(request_obj, False, request["client_address"]))
         logging.error("%s: %s" % (ERRORS[INVALID_REQUEST], request_obj.errors))
         return request_obj.errors, INVALID_REQUEST
 
-    if not check_auth(request_obj):
+    hot_callers.add(caller_key(request_obj, authorized, request["client_address"]))
+    if not authorized:
         logging.error("%s user %s: %d" % (ERRORS[FORBIDDEN],
                                           request_obj.login, FORBIDDEN))
         return request_obj.errors, FORBIDDEN
@@ -307,7 +374,13 @@ def method_handler(request, ctx, store):
     else:
         logging.info("Unknown method: %s" % method)
         return {"method": "Unknown method"}, INVALID_REQUEST
-    response, code = method_obj().handle(request_obj, ctx, store)
+    try:
+        if ctx.get("deadline") is not None and ctx["deadline"] <= time.time():
+            raise DeadlineExceeded("Deadline exceeded before handling")
+        response, code = method_obj().handle(request_obj, ctx, store)
+    except DeadlineExceeded as e:
+        logging.error("%s: %s" % (ERRORS[GATEWAY_TIMEOUT], e))
+        return None, GATEWAY_TIMEOUT
 
     logging.info("Returned context: %s, "
                  "response: %s, code: %s" % (ctx, response, code))
@@ -319,13 +392,46 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         "method": method_handler
     }
     store = RedisCache(config=REDIS_CONFIG)
+    # set when the worker is warmed up and can receive traffic
+    ready = threading.Event()
+    admission = None
+    # default time for request in seconds, None means no deadline
+    request_timeout = None
+    # responses shorter than this (in bytes) aren't compressed, None disables compression
+    compression_min_size = DEFAULT_MIN_SIZE
+    compression_level = DEFAULT_LEVEL
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def get_deadline(self, headers):
+        """ Deadline from X-Request-Timeout header (in milliseconds) or the default timeout """
+        timeout = self.request_timeout
+        try:
+            timeout = float(headers["X-Request-Timeout"]) / 1000
+        except (KeyError, TypeError, ValueError):
+            pass
+        return time.time() + timeout if timeout is not None else None
+
+    def admit(self, request, context):
+        """
+        Return None if the request is admitted otherwise code of the error.
+        Requests are rate limited per caller, the authorized request is passed
+        to the handler in context, so it isn't validated again
+        """
+        key = None
+        if self.admission.rate_limiter is not None:
+            request_obj, authorized = authorize(request)
+            key = caller_key(request_obj, authorized, self.client_address)
+        rejected_code = self.admission.admit(key)
+        if rejected_code is None and key is not None:
+            context["auth"] = request_obj, authorized
+        return rejected_code
+
     def do_POST(self):
         response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
+        context = {"request_id": self.get_request_id(self.headers),
+                   "deadline": self.get_deadline(self.headers)}
         request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
@@ -333,42 +439,234 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         except:
             code = BAD_REQUEST
 
-        if request:
+        if request and not isinstance(request, dict):
+            code = BAD_REQUEST
+        elif request:
             path = self.path.strip("/")
             logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception, e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
+                rejected_code = None
+                if self.admission is not None:
+                    rejected_code = self.admit(request, context)
+                if rejected_code is not None:
+                    code = rejected_code
+                else:
+                    try:
+                        response, code = self.router[path]({"body": request, "headers": self.headers,
+                                                            "client_address": self.client_address},
+                                                           context, self.store)
+                    except Exception, e:
+                        logging.exception("Unexpected error: %s" % e)
+                        code = INTERNAL_ERROR
+                    finally:
+                        if self.admission is not None:
+                            self.admission.release()
             else:
                 code = NOT_FOUND
 
+        self.send_json(response, code, context)
+        return
+
+    def do_GET(self):
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(self.headers)}
+        path = self.path.strip("/")
+        if path == "ready":
+            if self.ready.is_set():
+                response = {"ready": True}
+            else:
+                code = SERVICE_UNAVAILABLE
+        elif path == "metrics":
+            response = metrics.snapshot()
+        elif path == "admin/hotkeys":
+            if self.headers.get("X-Admin-Token") == admin_token():
+                response = {"keys": hot_keys.most_common(), "callers": hot_callers.most_common()}
+            else:
+                code = FORBIDDEN
+        else:
+            code = NOT_FOUND
+        self.send_json(response, code, context)
+
+    def send_json(self, response, code, context):
+        body, encoding = "", None
+        if code != NOT_MODIFIED:
+            if code not in ERRORS:
+                r = {"response": response, "code": code}
+            else:
+                r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+            context.update(r)
+            body = json.dumps(r)
+            if self.compression_min_size is not None and len(body) >= self.compression_min_size:
+                encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+        logging.info(context)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        if context.get("etag"):
+            self.send_header("ETag", context["etag"])
+        if self.compression_min_size is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        if encoding is not None:
+            write_compressed(self.wfile.write, body, encoding, self.compression_level)
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+            self.wfile.write(body)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """ Counts requests in progress, so the server can be stopped without dropping them """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.active = 0
+        self.idle = threading.Condition()
+
+    @classmethod
+    def from_fd(cls, fd, handler):
+        """ Server on already listening socket, e.g. inherited from master.py """
+        server = cls(("", 0), handler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        server.server_address = server.socket.getsockname()
+        server.server_name, server.server_port = server.server_address[:2]
+        return server
+
+    def process_request(self, request, client_address):
+        with self.idle:
+            self.active += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def wait_idle(self, timeout):
+        """ Wait until requests in progress are handled, return False on timeout """
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.active:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+
+def notify_ready(fd):
+    """ Write to the pipe from master.py when the worker is ready """
+    MainHTTPHandler.ready.wait()
+    os.write(fd, "1")
+    os.close(fd)
+
+
+def warm_up_and_set_ready(store, l1, ttl, snapshot_path, scan_limit):
+    try:
+        warm_up(store, l1, ttl, snapshot_path, scan_limit)
+    except Exception, e:
+        logging.exception("Error on cache warm up: %s" % e)
+    MainHTTPHandler.ready.set()
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--shm-cache", action="store", default=None,
+                  help="path to file of cache shared by workers on the host")
+    op.add_option("--shm-buckets", action="store", type=int, default=4096)
+    op.add_option("--shm-ttl", action="store", type=int, default=60)
+    op.add_option("--batch-window", action="store", type=float, default=0,
+                  help="seconds to collect concurrent reads into one MGET, 0 disables batching")
+    op.add_option("--batch-max-keys", action="store", type=int, default=64)
+    op.add_option("--snapshot", action="store", default=None,
+                  help="path to snapshot of the hottest shared memory cache values")
+    op.add_option("--snapshot-interval", action="store", type=int, default=60)
+    op.add_option("--warmup-scan-limit", action="store", type=int, default=DEFAULT_SCAN_LIMIT,
+                  help="number of keys to load from Redis if there is no snapshot, 0 disables it")
+    op.add_option("--rate", action="store", type=float, default=0,
+                  help="requests per second allowed for account and login, 0 disables rate limit")
+    op.add_option("--burst", action="store", type=int, default=10)
+    op.add_option("--shared-rate-limit", action="store_true", default=False,
+                  help="count requests of all workers in Redis")
+    op.add_option("--max-concurrency", action="store", type=int, default=0,
+                  help="requests handled at once, 0 disables the limit")
+    op.add_option("--max-queue", action="store", type=int, default=0)
+    op.add_option("--queue-timeout", action="store", type=float, default=0.05)
+    op.add_option("--request-timeout", action="store", type=float, default=None,
+                  help="default time for request in milliseconds if X-Request-Timeout header is not set")
+    op.add_option("--compress-min-size", action="store", type=int, default=DEFAULT_MIN_SIZE,
+                  help="minimal size of response in bytes to compress it, -1 disables compression")
+    op.add_option("--compress-level", action="store", type=int, default=DEFAULT_LEVEL)
+    op.add_option("--trace", action="store", default=None,
+                  help="path to file to append keys read and written in Redis, see cachesim.py")
+    op.add_option("--fd", action="store", type=int, default=None,
+                  help="listen on inherited socket instead of the port, used by master.py")
+    op.add_option("--ready-fd", action="store", type=int, default=None,
+                  help="pipe to write to when the worker is ready, used by master.py")
+    op.add_option("--drain-timeout", action="store", type=float, default=DRAIN_TIMEOUT,
+                  help="seconds to wait for requests in progress on SIGTERM")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    if opts.request_timeout:
+        MainHTTPHandler.request_timeout = opts.request_timeout / 1000
+    MainHTTPHandler.compression_min_size = opts.compress_min_size if opts.compress_min_size >= 0 else None
+    MainHTTPHandler.compression_level = opts.compress_level
+    if opts.batch_window or opts.trace:
+        MainHTTPHandler.store = RedisCache(config=dict(REDIS_CONFIG, BATCH_WINDOW=opts.batch_window,
+                                                       BATCH_MAX_KEYS=opts.batch_max_keys, TRACE_PATH=opts.trace))
+    redis_store = MainHTTPHandler.store
+    if opts.rate or opts.max_concurrency:
+        rate_limiter = concurrency_limiter = None
+        if opts.rate and opts.shared_rate_limit:
+            limiter_store = RedisCache(config=rate_limit_store_config(REDIS_CONFIG))
+            rate_limiter = RedisRateLimiter(limiter_store, opts.rate, opts.burst)
+        elif opts.rate:
+            rate_limiter = LocalRateLimiter(opts.rate, opts.burst)
+        if opts.max_concurrency:
+            concurrency_limiter = ConcurrencyLimiter(opts.max_concurrency, opts.max_queue, opts.queue_timeout)
+        MainHTTPHandler.admission = AdmissionController(rate_limiter, concurrency_limiter,
+                                                        TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE)
+    snapshot_writer = None
+    if opts.shm_cache:
+        l1 = SharedMemoryCache(opts.shm_cache, opts.shm_buckets)
+        MainHTTPHandler.store = TieredCache(l1, redis_store, opts.shm_ttl)
+        warm_up_thread = threading.Thread(target=warm_up_and_set_ready, args=(
+            redis_store, l1, opts.shm_ttl, opts.snapshot, opts.warmup_scan_limit))
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+        if opts.snapshot:
+            snapshot_writer = SnapshotWriter(l1, opts.snapshot, opts.snapshot_interval)
+            snapshot_writer.start()
+    else:
+        MainHTTPHandler.ready.set()
+    if opts.fd is not None:
+        server = ThreadedHTTPServer.from_fd(opts.fd, MainHTTPHandler)
+    else:
+        server = ThreadedHTTPServer(("localhost", opts.port), MainHTTPHandler)
+    if opts.ready_fd is not None:
+        notify_thread = threading.Thread(target=notify_ready, args=(opts.ready_fd,))
+        notify_thread.daemon = True
+        notify_thread.start()
+    # shutdown() waits for serve_forever() to return, so it can't be called in the handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info("Starting server at %s" % (server.server_address,))
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
+    logging.info("Stopping server, %d requests in progress" % server.active)
+    if not server.wait_idle(opts.drain_timeout):
+        logging.error("%d requests are not finished in %s seconds" % (server.active, opts.drain_timeout))
+    if snapshot_writer is not None:
+        snapshot_writer.stop()
+    if redis_store.trace is not None:
+        redis_store.trace.close()
     server.server_close()
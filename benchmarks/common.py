@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Allowed slowdown before a metric is treated as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+class DictStore(object):
+    """
+    In-memory stand-in for `store.RedisCache`.
+    It has the same interface so scoring functions
+    and handlers can be measured without Redis.
+    """
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    def cache_get(self, key, deadline=None):
+        return self.data.get(key)
+
+    def cache_set(self, key, value, expired=None, deadline=None):
+        self.data[key] = value
+
+    def cache_get_many(self, keys, deadline=None):
+        return [self.data.get(key) for key in keys]
+
+    def get(self, key, deadline=None):
+        return self.data.get(key)
+
+    def get_many(self, keys, deadline=None):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, deadline=None):
+        self.data[key] = value
+
+    def delete(self, key, deadline=None):
+        self.data.pop(key, None)
+
+
+def measure(func, number=10000, repeat=5):
+    """
+    Run `func` `number` times in `repeat` rounds and
+    return stats of the best round as ops/sec and ns/op
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    best = max(best, 1e-9)
+    return {
+        "ops_per_sec": number / best,
+        "ns_per_op": best / number * 1e9,
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_higher_better(metric):
+    return metric.endswith("per_sec")
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare results with baseline and return list of
+    regressions as (benchmark, metric, baseline, current).
+    Metrics `*per_sec` are better when higher,
+    all the others (latencies) are better when lower
+    and any growth of `errors` is a regression.
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric, value in sorted(metrics.items()):
+            base_value = baseline[name].get(metric)
+            if base_value is None:
+                continue
+            if metric == "errors":
+                regressed = value > base_value
+            elif is_higher_better(metric):
+                regressed = value < base_value * (1 - tolerance)
+            else:
+                regressed = value > base_value * (1 + tolerance)
+            if regressed:
+                regressions.append((name, metric, base_value, value))
+    return regressions
+
+
+def report(results, baseline_path=None, output_path=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print results, save them and check against baseline.
+    Returns exit code: 1 if there are regressions otherwise 0
+    """
+    for name, metrics in sorted(results.items()):
+        print "%-40s %s" % (name, ", ".join(
+            "%s=%.2f" % (metric, value) for metric, value in sorted(metrics.items())
+        ))
+    if output_path:
+        save_results(output_path, results)
+    if not baseline_path:
+        return 0
+    if not os.path.exists(baseline_path):
+        print "Baseline %s not found, saving current results as baseline" % baseline_path
+        save_results(baseline_path, results)
+        return 0
+    regressions = compare(results, load_results(baseline_path), tolerance)
+    for name, metric, base_value, value in regressions:
+        print "REGRESSION %s %s: %.2f -> %.2f" % (name, metric, base_value, value)
+    return 1 if regressions else 0
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Load generator for scoring API.
+
+It replays requests from jsonl file (one request body per line,
+`token` is calculated if it's missing) with given concurrency
+and reports throughput and latency percentiles.
+If `--url` is not set the API is started in-process
+with in-memory store so it runs fully locally.
+
+$ python benchmarks/load.py -f benchmarks/traffic.jsonl -c 8 -n 5000 --baseline load_baseline.json
+"""
+import datetime
+import hashlib
+import httplib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urlparse
+
+from itertools import cycle
+from optparse import OptionParser
+
+from common import DictStore, DEFAULT_TOLERANCE, percentile, report
+
+import api
+
+DEFAULT_TRAFFIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traffic.jsonl")
+
+
+def sign(body):
+    if body.get("token"):
+        return body
+    login, account = body.get("login", ""), body.get("account", "")
+    if login == api.ADMIN_LOGIN:
+        body["token"] = hashlib.sha512(
+            datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    else:
+        body["token"] = hashlib.sha512(account + login + api.SALT).hexdigest()
+    return body
+
+
+def load_traffic(path):
+    with open(path) as f:
+        return [json.dumps(sign(json.loads(line))) for line in f if line.strip()]
+
+
+def start_local_server(store):
+    class LocalHandler(api.MainHTTPHandler):
+        def log_message(self, format, *args):
+            pass
+    LocalHandler.store = store
+    server = api.ThreadedHTTPServer(("127.0.0.1", 0), LocalHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d/method" % server.server_address[1]
+
+
+class Worker(threading.Thread):
+    def __init__(self, url, bodies, requests_number):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.url = urlparse.urlparse(url)
+        self.bodies = bodies
+        self.requests_number = requests_number
+        self.latencies = []
+        self.errors = 0
+
+    def send(self, body):
+        conn = httplib.HTTPConnection(self.url.hostname, self.url.port)
+        try:
+            conn.request("POST", self.url.path, body, {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        finally:
+            conn.close()
+
+    def run(self):
+        bodies = cycle(self.bodies)
+        for _ in xrange(self.requests_number):
+            started = time.time()
+            try:
+                status = self.send(next(bodies))
+            except Exception:
+                status = None
+            self.latencies.append(time.time() - started)
+            if status is None or status >= api.INTERNAL_ERROR:
+                self.errors += 1
+
+
+def run(url, bodies, concurrency, requests_number):
+    per_worker = max(requests_number // concurrency, 1)
+    workers = [Worker(url, bodies[i::concurrency] or bodies, per_worker)
+               for i in range(concurrency)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    latencies = sorted(l for worker in workers for l in worker.latencies)
+    return {
+        "load.c%d" % concurrency: {
+            "requests_per_sec": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "p999_ms": percentile(latencies, 99.9) * 1000,
+            "errors": sum(worker.errors for worker in workers),
+        }
+    }
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-f", "--file", action="store", default=DEFAULT_TRAFFIC)
+    op.add_option("-u", "--url", action="store", default=None)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=4)
+    op.add_option("-n", "--number", action="store", type=int, default=2000)
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("-b", "--baseline", action="store", default=None)
+    op.add_option("-t", "--tolerance", action="store", type=float, default=DEFAULT_TOLERANCE)
+    op.add_option("-l", "--log", action="store", default=os.devnull)
+    (opts, args) = op.parse_args()
+    # `store` configures root logger on import, replace it to keep output clean
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+
+    server = None
+    url = opts.url
+    if url is None:
+        server, url = start_local_server(DictStore())
+    try:
+        results = run(url, load_traffic(opts.file), opts.concurrency, opts.number)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    sys.exit(report(results, opts.baseline, opts.output, opts.tolerance))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for scoring API building blocks.
+
+$ python benchmarks/micro.py --output micro.json --baseline micro_baseline.json
+"""
+import datetime
+import hashlib
+import json
+import sys
+
+from optparse import OptionParser
+
+from common import DictStore, DEFAULT_TOLERANCE, measure, report
+
+import api
+from dates import parse_dates
+from scoring import get_score, get_interests, get_interests_many
+
+SCORE_ARGUMENTS = {
+    "phone": "79175002040",
+    "email": "john@example.com",
+    "first_name": "John",
+    "last_name": "Doe",
+    "birthday": "01.01.1990",
+    "gender": 1,
+}
+INTERESTS_ARGUMENTS = {
+    "client_ids": [1, 2, 3, 4],
+    "date": "20.07.2017",
+}
+
+
+class MissStore(DictStore):
+    """ Store which never keeps cached values """
+    def cache_set(self, key, value, expired=None, deadline=None):
+        pass
+
+
+def make_method_request(login="h&f", account="horns&hoofs"):
+    body = {
+        "account": account,
+        "login": login,
+        "method": "online_score",
+        "token": hashlib.sha512(account + login + api.SALT).hexdigest(),
+        "arguments": SCORE_ARGUMENTS,
+    }
+    request = api.MethodRequest(**body)
+    request.is_valid()
+    return request
+
+
+def bench_online_score_request():
+    api.OnlineScoreRequest(**SCORE_ARGUMENTS).is_valid()
+
+
+def bench_clients_interests_request():
+    api.ClientsInterestsRequest(**INTERESTS_ARGUMENTS).is_valid()
+
+
+def run(number, repeat):
+    method_request = make_method_request()
+    birthday = datetime.datetime(1990, 1, 1)
+    score_kwargs = dict(phone="79175002040", email="john@example.com", birthday=birthday,
+                        gender=1, first_name="John", last_name="Doe")
+    hit_store = DictStore()
+    get_score(hit_store, **score_kwargs)
+    miss_store = MissStore()
+    interests_store = DictStore({"i:1": json.dumps(["books", "hi-tech", "pets", "tv"])})
+    dates_column = ["%02d.%02d.%d" % (day, month, year) for day in range(1, 29)
+                    for month in (1, 6) for year in (1970, 1990, 2010)]
+
+    benchmarks = {
+        "fields.online_score_request": bench_online_score_request,
+        "fields.clients_interests_request": bench_clients_interests_request,
+        "fields.parse_dates_column": lambda: parse_dates(dates_column),
+        "auth.check_auth": lambda: api.check_auth(method_request),
+        "scoring.get_score_hit": lambda: get_score(hit_store, **score_kwargs),
+        "scoring.get_score_miss": lambda: get_score(miss_store, **score_kwargs),
+        "scoring.get_interests": lambda: get_interests(interests_store, 1),
+        "scoring.get_interests_many": lambda: get_interests_many(interests_store, [1, 2, 3, 4]),
+    }
+    return {name: measure(func, number, repeat) for name, func in benchmarks.items()}
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=10000)
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("-b", "--baseline", action="store", default=None)
+    op.add_option("-t", "--tolerance", action="store", type=float, default=DEFAULT_TOLERANCE)
+    (opts, args) = op.parse_args()
+    results = run(opts.number, opts.repeat)
+    sys.exit(report(results, opts.baseline, opts.output, opts.tolerance))
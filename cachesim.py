@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+Replays key traces recorded by `RedisCache` (see "TRACE_PATH") against
+eviction policies with different cache sizes and TTLs and reports hit rates.
+Traces are read in one streaming pass, all the caches are simulated at once.
+
+$ python cachesim.py --prefix uid: --sizes 1000,10000,100000 --ttls 0,60,3600 trace.bin
+"""
+import itertools
+import json
+import logging
+import sys
+import zlib
+
+from collections import OrderedDict, defaultdict
+from optparse import OptionParser
+
+from hotkeys import CountMinSketch
+from keytrace import read_trace, READ, WRITE, DELETE
+
+INFINITY = float("inf")
+PROGRESS_EVERY = 10 ** 7   # events
+
+
+class LRUCache(object):
+    """
+    Caches below keep key -> value, `get` returns None for missing
+    keys and counts as access, `set` of a cached key only updates value.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.pop(key, None)
+        if value is not None:
+            self.data[key] = value
+        return value
+
+    def set(self, key, value):
+        if key not in self.data and len(self.data) >= self.capacity:
+            self.data.popitem(last=False)
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class LFUCache(object):
+    """ Least frequently used key is evicted, the least recent one among equal """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.values = {}
+        self.freqs = {}
+        self.buckets = defaultdict(OrderedDict)
+        self.min_freq = 0
+
+    def _remove_from_bucket(self, key, freq):
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[freq]
+
+    def get(self, key):
+        if key not in self.values:
+            return None
+        freq = self.freqs[key]
+        self._remove_from_bucket(key, freq)
+        if self.min_freq == freq and freq not in self.buckets:
+            self.min_freq = freq + 1
+        self.freqs[key] = freq + 1
+        self.buckets[freq + 1][key] = None
+        return self.values[key]
+
+    def set(self, key, value):
+        if key not in self.values:
+            if len(self.values) >= self.capacity:
+                if self.min_freq not in self.buckets:
+                    self.min_freq = min(self.buckets)
+                victim, _ = self.buckets[self.min_freq].popitem(last=False)
+                if not self.buckets[self.min_freq]:
+                    del self.buckets[self.min_freq]
+                del self.values[victim]
+                del self.freqs[victim]
+            self.freqs[key] = 1
+            self.buckets[1][key] = None
+            self.min_freq = 1
+        self.values[key] = value
+
+    def delete(self, key):
+        if key in self.values:
+            self._remove_from_bucket(key, self.freqs.pop(key))
+            del self.values[key]
+
+
+class ARCCache(object):
+    """
+    Adaptive replacement cache (Megiddo & Modha): keys seen once (t1) and
+    more (t2) with ghost lists of their evicted keys (b1, b2) which adapt
+    target size `p` of t1.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.p = 0.0
+        self.t1, self.t2 = OrderedDict(), OrderedDict()
+        self.b1, self.b2 = OrderedDict(), OrderedDict()
+
+    def get(self, key):
+        if key in self.t1:
+            value = self.t2[key] = self.t1.pop(key)
+            return value
+        if key in self.t2:
+            value = self.t2[key] = self.t2.pop(key)
+            return value
+        return None
+
+    def _replace(self, in_b2):
+        if len(self.t1) + len(self.t2) < self.capacity:
+            return
+        if self.t1 and (len(self.t1) > self.p or (in_b2 and len(self.t1) == self.p) or not self.t2):
+            old, _ = self.t1.popitem(last=False)
+            self.b1[old] = None
+        else:
+            old, _ = self.t2.popitem(last=False)
+            self.b2[old] = None
+
+    def set(self, key, value):
+        if key in self.t1:
+            self.t1[key] = value
+        elif key in self.t2:
+            self.t2[key] = value
+        elif key in self.b1:
+            self.p = min(self.capacity, self.p + max(len(self.b2) / float(len(self.b1)), 1))
+            self._replace(False)
+            del self.b1[key]
+            self.t2[key] = value
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) / float(len(self.b2)), 1))
+            self._replace(True)
+            del self.b2[key]
+            self.t2[key] = value
+        else:
+            l1 = len(self.t1) + len(self.b1)
+            total = l1 + len(self.t2) + len(self.b2)
+            if l1 >= self.capacity:
+                if len(self.t1) < self.capacity:
+                    self.b1.popitem(last=False)
+                    self._replace(False)
+                else:
+                    self.t1.popitem(last=False)
+            elif total >= self.capacity:
+                if total >= 2 * self.capacity and self.b2:
+                    self.b2.popitem(last=False)
+                self._replace(False)
+            self.t1[key] = value
+
+    def delete(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+
+
+class TinyLFUCache(object):
+    """
+    W-TinyLFU: new keys get into small LRU window, keys evicted from it
+    are admitted to the main segmented LRU only if they are accessed more
+    often than its victim. Frequencies are estimated by count-min sketch
+    which is halved after `10 * capacity` accesses.
+    """
+    WINDOW = 0.01
+    PROTECTED = 0.8
+
+    def __init__(self, capacity):
+        self.window_size = max(1, int(capacity * self.WINDOW))
+        self.main_size = capacity - self.window_size
+        self.protected_size = int(self.main_size * self.PROTECTED)
+        self.window, self.probation, self.protected = OrderedDict(), OrderedDict(), OrderedDict()
+        self.sketch = CountMinSketch(width=max(64, capacity * 2))
+        self.sample_size = 10 * capacity
+        self.accesses = 0
+
+    def _count(self, key):
+        self.sketch.add(key)
+        self.accesses += 1
+        if self.accesses >= self.sample_size:
+            self.sketch.halve()
+            self.accesses //= 2
+
+    def get(self, key):
+        self._count(key)
+        if key in self.window:
+            value = self.window[key] = self.window.pop(key)
+        elif key in self.protected:
+            value = self.protected[key] = self.protected.pop(key)
+        elif key in self.probation:
+            value = self.protected[key] = self.probation.pop(key)
+            if len(self.protected) > self.protected_size:
+                demoted, demoted_value = self.protected.popitem(last=False)
+                self.probation[demoted] = demoted_value
+        else:
+            value = None
+        return value
+
+    def set(self, key, value):
+        for segment in (self.window, self.protected, self.probation):
+            if key in segment:
+                segment[key] = value
+                return
+        self.window[key] = value
+        if len(self.window) > self.window_size:
+            self._admit(*self.window.popitem(last=False))
+
+    def _admit(self, candidate, value):
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[candidate] = value
+            return
+        segment = self.probation if self.probation else self.protected
+        if not segment:
+            return
+        victim = next(iter(segment))
+        if self.sketch.estimate(candidate) > self.sketch.estimate(victim):
+            del segment[victim]
+            self.probation[candidate] = value
+
+    def delete(self, key):
+        for segment in (self.window, self.protected, self.probation):
+            segment.pop(key, None)
+
+
+POLICIES = OrderedDict([
+    ("lru", LRUCache),
+    ("lfu", LFUCache),
+    ("arc", ARCCache),
+    ("tinylfu", TinyLFUCache),
+])
+
+
+class Simulation(object):
+    """ Cache of the policy with TTL of values (in seconds, 0 means no expiration) """
+    def __init__(self, policy, size, ttl, capacity=None):
+        self.policy = policy
+        self.size = size
+        self.ttl = ttl
+        self.cache = POLICIES[policy](capacity or size)
+        self.reads = 0
+        self.hits = 0
+
+    def read(self, key, now):
+        """ Missed keys are loaded into the cache """
+        self.reads += 1
+        expires = self.cache.get(key)
+        if expires is not None:
+            if expires > now:
+                self.hits += 1
+                return
+            self.cache.delete(key)
+        self.write(key, now)
+
+    def write(self, key, now):
+        self.cache.set(key, now + self.ttl if self.ttl else INFINITY)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    @property
+    def hit_rate(self):
+        return self.hits / float(self.reads) if self.reads else 0.0
+
+    def to_dict(self):
+        return {"policy": self.policy, "size": self.size, "ttl": self.ttl,
+                "reads": self.reads, "hits": self.hits, "hit_rate": self.hit_rate}
+
+
+def simulate(events, policies, sizes, ttls, sample=1.0):
+    """
+    Replay (time, operation, key) events. If `sample` is less than 1 only
+    this share of keys (chosen by hash) is replayed against caches of
+    proportionally smaller sizes, which is much faster for huge traces.
+    """
+    simulations = [Simulation(policy, size, ttl, max(1, int(size * sample)))
+                   for policy, size, ttl in itertools.product(policies, sizes, ttls)]
+    threshold = int(sample * 2 ** 32)
+    for number, (now, op, key) in enumerate(events, 1):
+        if number % PROGRESS_EVERY == 0:
+            logging.info("%d events replayed" % number)
+        if sample < 1 and zlib.crc32(key) & 0xffffffff >= threshold:
+            continue
+        if op == READ:
+            for simulation in simulations:
+                simulation.read(key, now)
+        elif op == WRITE:
+            for simulation in simulations:
+                simulation.write(key, now)
+        elif op == DELETE:
+            for simulation in simulations:
+                simulation.delete(key)
+    return simulations
+
+
+def read_traces(paths, prefix=None, limit=None):
+    events = itertools.chain.from_iterable(read_trace(path) for path in paths)
+    if prefix:
+        events = (event for event in events if event[2].startswith(prefix))
+    return itertools.islice(events, limit)
+
+
+def print_curves(simulations, sizes, out=sys.stdout):
+    """ Table of hit rates, row per policy and TTL, column per cache size """
+    out.write("%-10s %8s" % ("policy", "ttl") + "".join("%10s" % size for size in sizes) + "\n")
+    rows = OrderedDict()
+    for simulation in simulations:
+        rows.setdefault((simulation.policy, simulation.ttl), []).append(simulation)
+    for (policy, ttl), row in rows.items():
+        out.write("%-10s %8s" % (policy, ttl) +
+                  "".join("%9.2f%%" % (simulation.hit_rate * 100) for simulation in row) + "\n")
+
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] TRACE [TRACE ...]")
+    op.add_option("--policies", action="store", default=",".join(POLICIES))
+    op.add_option("--sizes", action="store", default="1000,10000,100000",
+                  help="cache sizes in keys")
+    op.add_option("--ttls", action="store", default="0",
+                  help="TTLs in seconds, 0 means no expiration")
+    op.add_option("--prefix", action="store", default=None,
+                  help="replay only keys with the prefix, e.g. uid: for scores")
+    op.add_option("--sample", action="store", type=float, default=1.0,
+                  help="share of keys to replay")
+    op.add_option("-n", "--limit", action="store", type=int, default=None,
+                  help="replay only first events")
+    op.add_option("-o", "--output", action="store", default=None,
+                  help="save results as JSON")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    if not args:
+        op.error("trace file is required")
+    policies = parse_list(opts.policies, str)
+    unknown = set(policies) - set(POLICIES)
+    if unknown:
+        op.error("unknown policies: %s" % ", ".join(sorted(unknown)))
+    sizes = parse_list(opts.sizes)
+    simulations = simulate(read_traces(args, opts.prefix, opts.limit), policies, sizes,
+                           parse_list(opts.ttls), opts.sample)
+    print_curves(simulations, sizes)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump([simulation.to_dict() for simulation in simulations], f, indent=2)
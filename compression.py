@@ -0,0 +1,66 @@
+import time
+import zlib
+
+from metrics import metrics as default_metrics
+
+DEFAULT_MIN_SIZE = 1024   # in bytes
+DEFAULT_LEVEL = 6
+CHUNK_SIZE = 16 * 1024
+# Preferred encoding goes first
+ENCODINGS = ("gzip", "deflate")
+
+
+def choose_encoding(accept_encoding):
+    """ Return the best supported encoding from Accept-Encoding header or None """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        parts = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0
+        weights[parts[0].lower()] = weight
+    candidates = [(weights.get(encoding, weights.get("*", 0)), -index, encoding)
+                  for index, encoding in enumerate(ENCODINGS)]
+    weight, _, encoding = max(candidates)
+    return encoding if weight > 0 else None
+
+
+def make_compressor(encoding, level=DEFAULT_LEVEL):
+    # gzip has its own header, deflate in HTTP means zlib format
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def write_compressed(write, body, encoding, level=DEFAULT_LEVEL, metrics=default_metrics):
+    """
+    Compress body in pieces of CHUNK_SIZE bytes and write them out
+    as they are ready. Sizes, ratio and time spent in compressor
+    are reported to metrics.
+    """
+    compressor = make_compressor(encoding, level)
+    size_out = 0
+    spent = 0.0
+    for start in xrange(0, len(body), CHUNK_SIZE):
+        started = time.time()
+        data = compressor.compress(body[start:start + CHUNK_SIZE])
+        spent += time.time() - started
+        size_out += len(data)
+        if data:
+            write(data)
+    started = time.time()
+    data = compressor.flush()
+    spent += time.time() - started
+    size_out += len(data)
+    write(data)
+
+    metrics.inc("compression.%s.responses" % encoding)
+    metrics.inc("compression.bytes_in", len(body))
+    metrics.inc("compression.bytes_out", size_out)
+    metrics.observe("compression.ratio_percent", size_out * 100.0 / max(len(body), 1))
+    metrics.observe("compression.time_ms", spent * 1000)
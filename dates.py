@@ -0,0 +1,69 @@
+import datetime
+
+DATE_FORMAT = "%d.%m.%Y"
+# Parsed strings are remembered until there are this many of them
+MEMO_SIZE = 10000
+DIGITS = frozenset("0123456789")
+
+_memo = {}
+
+
+def _parse_canonical(value):
+    """ Parse dd.mm.yyyy with ASCII digits, return None for other forms """
+    if len(value) != 10 or value[2] != "." or value[5] != ".":
+        return None
+    day, month, year = value[:2], value[3:5], value[6:]
+    if not DIGITS.issuperset(day + month + year):
+        return None
+    return datetime.datetime(int(year), int(month), int(day))
+
+
+def parse_date(value):
+    """
+    Parse date in DATE_FORMAT, raises ValueError for invalid ones.
+    Canonical dd.mm.yyyy is parsed by hand, other forms accepted
+    by strptime (e.g. 1.2.2000) fall back to it.
+    """
+    parsed = _memo.get(value)
+    if parsed is None:
+        parsed = _parse_canonical(value) or datetime.datetime.strptime(value, DATE_FORMAT)
+        if len(_memo) >= MEMO_SIZE:
+            _memo.clear()
+        _memo[value] = parsed
+    return parsed
+
+
+def parse_dates(values):
+    """ Parse column of dates, invalid values are None in the result """
+    parsed = []
+    for value in values:
+        try:
+            parsed.append(parse_date(value))
+        except (TypeError, ValueError):
+            parsed.append(None)
+    return parsed
+
+
+class AgeCutoff(object):
+    """ The earliest allowed date of birth, it's computed once per day """
+    def __init__(self, years, today=datetime.date.today):
+        self.years = years
+        self.today = today
+        self.day = None
+        self.cutoff = None
+
+    def __call__(self):
+        today = self.today()
+        if today != self.day:
+            midnight = datetime.datetime.combine(today, datetime.time())
+            self.cutoff, self.day = midnight - datetime.timedelta(days=365 * self.years), today
+        return self.cutoff
+
+    def is_too_old(self, birthday):
+        return birthday <= self()
+
+    def validate_many(self, values):
+        """ Parse column of birthdays, invalid and too old ones are None in the result """
+        cutoff = self()
+        return [birthday if birthday is not None and birthday > cutoff else None
+                for birthday in parse_dates(values)]
@@ -0,0 +1,126 @@
+import heapq
+import random
+import threading
+import time
+
+DEFAULT_WIDTH = 2048
+DEFAULT_DEPTH = 4
+DEFAULT_TOP_SIZE = 100
+# All counters are halved every interval, so old traffic fades out
+DEFAULT_DECAY_INTERVAL = 60   # in seconds
+# Only one of this many store reads is counted (with the weight of all of them)
+KEYS_SAMPLE = 16
+
+
+class CountMinSketch(object):
+    """
+    Approximate counters in fixed memory of `depth` rows of `width` counters.
+    Estimate is never less than the real count and overestimates
+    by at most 2 * total / width with probability 1 - 1 / 2 ** depth.
+    """
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        # row hashes are derived from one hash: h1 + i * h2
+        h = hash(key) & 0xffffffffffffffff
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """ Increment counter of the key and return its estimate """
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def halve(self, times=1):
+        for row in self.rows:
+            row[:] = [count >> times for count in row]
+
+
+class HeavyHitters(object):
+    """
+    Thread-safe tracker of `size` most frequent keys. Counts are
+    estimated by count-min sketch, the keys with the biggest counts
+    are kept in a min-heap. Memory doesn't depend on number of keys.
+    If `sample` is more than 1 only a random one of `sample` keys
+    is counted, `sample` times, so counts stay about the same
+    for a fraction of the cost.
+    """
+    def __init__(self, size=DEFAULT_TOP_SIZE, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH,
+                 decay_interval=DEFAULT_DECAY_INTERVAL, clock=time.time, sample=1):
+        self.size = size
+        self.sample = sample
+        self.sketch = CountMinSketch(width, depth)
+        self.decay_interval = decay_interval
+        self.clock = clock
+        self.decayed_at = clock()
+        # heap entries may have stale counts, actual ones are in `top`
+        self.heap = []
+        self.top = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, count=1):
+        self.add_many([key], count)
+
+    def add_many(self, keys, count=1):
+        if self.sample > 1:
+            keys = keys[random.randrange(self.sample)::self.sample]
+            if not keys:
+                return
+            count *= self.sample
+        with self.lock:
+            if self.decay_interval:
+                intervals = int((self.clock() - self.decayed_at) // self.decay_interval)
+                if intervals > 0:
+                    self._decay(intervals)
+            for key in keys:
+                self._add(key, count)
+
+    def _add(self, key, count):
+        estimate = self.sketch.add(key, count)
+        if key in self.top:
+            self.top[key] = estimate
+        elif len(self.top) < self.size:
+            self.top[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        elif estimate > self.heap[0][0]:
+            # refresh stale entries until the minimum is actual
+            while self.top[self.heap[0][1]] != self.heap[0][0]:
+                victim = self.heap[0][1]
+                heapq.heapreplace(self.heap, (self.top[victim], victim))
+            if estimate > self.heap[0][0]:
+                _, victim = heapq.heapreplace(self.heap, (estimate, key))
+                del self.top[victim]
+                self.top[key] = estimate
+
+    def _decay(self, intervals):
+        """ Halve counters once for every passed interval """
+        self.sketch.halve(intervals)
+        self.top = {key: count >> intervals for key, count in self.top.items()}
+        self.heap = [(count, key) for key, count in self.top.items()]
+        heapq.heapify(self.heap)
+        self.decayed_at += intervals * self.decay_interval
+
+    def estimate(self, key):
+        with self.lock:
+            return self.sketch.estimate(key)
+
+    def most_common(self, limit=None):
+        """ List of (key, count) sorted by count, the most frequent first """
+        with self.lock:
+            items = sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+        return items[:limit] if limit is not None else items
+
+
+# Keys read from the store and callers (account/login) of the API
+hot_keys = HeavyHitters(sample=KEYS_SAMPLE)
+hot_callers = HeavyHitters()
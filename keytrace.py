@@ -0,0 +1,88 @@
+import os
+import struct
+import threading
+import time
+
+# Record is the header followed by the key:
+# time in seconds since the epoch, operation and length of the key
+RECORD_HEADER = struct.Struct("<IBH")
+READ, WRITE, DELETE = 0, 1, 2
+DEFAULT_BUFFER_SIZE = 64 * 1024   # in bytes
+READ_CHUNK_SIZE = 1024 * 1024   # in bytes
+
+
+def encode_key(key):
+    return key.encode("utf-8") if isinstance(key, unicode) else str(key)
+
+
+class TraceWriter(object):
+    """
+    Appends key accesses to the binary trace file. Records are
+    buffered and written with one write() in append mode, so
+    several workers can write to the same file.
+    """
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, clock=time.time):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.clock = clock
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.buffer = []
+        self.buffered = 0
+        self.lock = threading.Lock()
+
+    def record(self, key, op=READ):
+        self.record_many([key], op)
+
+    def record_many(self, keys, op=READ):
+        now = int(self.clock())
+        records = []
+        for key in keys:
+            key = encode_key(key)[:0xffff]
+            records.append(RECORD_HEADER.pack(now, op, len(key)) + key)
+        with self.lock:
+            self.buffer.extend(records)
+            self.buffered += sum(len(record) for record in records)
+            if self.buffered >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            os.write(self.fd, "".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._flush()
+                os.close(self.fd)
+                self.fd = None
+
+
+def read_trace(path, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yield (time, operation, key) records of the trace file without
+    loading it into memory. Incomplete record at the end is skipped.
+    """
+    header_size = RECORD_HEADER.size
+    unpack_from = RECORD_HEADER.unpack_from
+    with open(path, "rb") as f:
+        data = ""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = data[offset:] + chunk if data else chunk
+            offset = 0
+            end = len(data)
+            while offset + header_size <= end:
+                timestamp, op, length = unpack_from(data, offset)
+                if offset + header_size + length > end:
+                    break
+                start = offset + header_size
+                yield timestamp, op, data[start:start + length]
+                offset = start + length
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Master process which holds the listening socket and runs API workers (api.py).
+On SIGHUP workers are replaced one by one with workers of the current api.py:
+an old worker is stopped only when the new one is ready, so nothing is dropped.
+Stopped workers finish requests in progress and flush snapshot and trace.
+On SIGTERM or SIGINT all the workers are stopped the same way and master exits.
+Options after -- are passed to workers.
+
+$ python master.py -p 8080 -w 4 -- --shm-cache /dev/shm/scoring.cache --snapshot /var/tmp/scoring.snapshot
+$ kill -HUP <master pid>
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py")
+DEFAULT_READY_TIMEOUT = 60   # in seconds
+DEFAULT_DRAIN_TIMEOUT = 30   # in seconds
+# Pause between starts of workers, so they don't connect to Redis all at once
+DEFAULT_START_DELAY = 1   # in seconds
+CHECK_INTERVAL = 0.5   # in seconds
+
+
+def set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+class Worker(object):
+    def __init__(self, process, ready_fd):
+        self.process = process
+        self.ready_fd = ready_fd
+        self.stopped_at = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def wait_ready(self, timeout):
+        """ Wait until the worker writes to the pipe, False if it exits or timeout is over """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self.ready_fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                return os.read(self.ready_fd, 1) == "1"
+
+    def stop(self):
+        if self.stopped_at is None:
+            self.stopped_at = time.time()
+            self.process.send_signal(signal.SIGTERM)
+        self.close()
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        self.close()
+
+    def close(self):
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+
+class Master(object):
+    def __init__(self, address, workers=1, worker_args=(), ready_timeout=DEFAULT_READY_TIMEOUT,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, start_delay=DEFAULT_START_DELAY, command=None):
+        self.address = address
+        self.number = workers
+        self.worker_args = list(worker_args)
+        self.ready_timeout = ready_timeout
+        self.drain_timeout = drain_timeout
+        self.start_delay = start_delay
+        self.command = command or [sys.executable, API_PATH]
+        self.socket = None
+        self.workers = []
+        self.stopping = []
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def listen(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(128)
+        self.address = self.socket.getsockname()
+        return self
+
+    def spawn(self):
+        """ Start worker and wait until it's ready, None if it isn't ready in time """
+        read_fd, write_fd = os.pipe()
+        set_cloexec(read_fd)
+        args = ["--fd", str(self.socket.fileno()), "--ready-fd", str(write_fd),
+                "--drain-timeout", str(self.drain_timeout)]
+        process = subprocess.Popen(self.command + args + self.worker_args, close_fds=False)
+        os.close(write_fd)
+        worker = Worker(process, read_fd)
+        if not worker.wait_ready(self.ready_timeout):
+            logging.error("Worker %d isn't ready in %s seconds" % (worker.pid, self.ready_timeout))
+            worker.kill()
+            return None
+        worker.close()
+        logging.info("Worker %d is ready" % worker.pid)
+        return worker
+
+    def start(self):
+        for index in range(self.number):
+            if index:
+                time.sleep(self.start_delay)
+            worker = self.spawn()
+            if worker is None:
+                raise RuntimeError("Worker can't be started")
+            self.workers.append(worker)
+        return self
+
+    def reload(self):
+        """ Replace workers one by one, reload is aborted if a new worker isn't ready """
+        logging.info("Reloading workers")
+        for index, old in enumerate(list(self.workers)):
+            if index:
+                time.sleep(self.start_delay)
+            new = self.spawn()
+            if new is None:
+                logging.error("Reload is aborted")
+                return False
+            self.workers[self.workers.index(old)] = new
+            self.stop_worker(old)
+        return True
+
+    def stop_worker(self, worker):
+        logging.info("Stopping worker %d" % worker.pid)
+        worker.stop()
+        self.stopping.append(worker)
+
+    def check_workers(self):
+        """ Reap stopped workers, kill ones draining too long and replace exited ones """
+        for worker in list(self.stopping):
+            if worker.process.poll() is not None:
+                self.stopping.remove(worker)
+            elif time.time() - worker.stopped_at > self.drain_timeout + CHECK_INTERVAL * 2:
+                logging.error("Worker %d isn't stopped in time, killing it" % worker.pid)
+                worker.kill()
+                self.stopping.remove(worker)
+        for worker in list(self.workers):
+            if worker.process.poll() is not None and not self.stop_requested:
+                logging.error("Worker %d exited with code %s" % (worker.pid, worker.process.returncode))
+                time.sleep(self.start_delay)
+                new = self.spawn()
+                if new is not None:
+                    self.workers[self.workers.index(worker)] = new
+
+    def stop(self):
+        for worker in self.workers:
+            self.stop_worker(worker)
+        self.workers = []
+        while self.stopping:
+            self.check_workers()
+            time.sleep(CHECK_INTERVAL)
+        self.socket.close()
+
+    def on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def on_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.check_workers()
+            time.sleep(CHECK_INTERVAL)
+        logging.info("Stopping master")
+        self.stop()
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [-- worker options]")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("--host", action="store", default="localhost")
+    op.add_option("-w", "--workers", action="store", type=int, default=2)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--ready-timeout", action="store", type=float, default=DEFAULT_READY_TIMEOUT)
+    op.add_option("--drain-timeout", action="store", type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    op.add_option("--start-delay", action="store", type=float, default=DEFAULT_START_DELAY,
+                  help="seconds between starts of workers")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    master = Master((opts.host, opts.port), opts.workers, args, opts.ready_timeout,
+                    opts.drain_timeout, opts.start_delay).listen()
+    logging.info("Master %d is listening at %s:%s" % ((os.getpid(),) + master.address))
+    master.start().run()
@@ -0,0 +1,59 @@
+import threading
+
+from collections import defaultdict
+
+# Upper bounds of histogram buckets
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+
+    def to_dict(self):
+        buckets = {"le_%s" % bound: count for bound, count in zip(self.buckets, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.total, "max": self.max, "buckets": buckets}
+
+
+class Metrics(object):
+    """ Thread-safe registry of counters and histograms """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+
+metrics = Metrics()
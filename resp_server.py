@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+In-process server which speaks Redis protocol (RESP).
+
+It supports the commands used by `store.RedisCache` and
+allows to inject per-command latency, dropped replies and
+disconnects to check how the store behaves with slow or flaky
+backend without external services.
+
+    server = RespServer(faults=FaultPlan(latency={"GET": uniform(0.01, 0.02)},
+                                         drop={"SET": 0.5}, seed=42)).start()
+    store = RedisCache(config=dict(REDIS_CONFIG, PORT=server.port))
+    ...
+    server.stop()
+
+It also can be run as standalone server:
+
+    $ python resp_server.py -p 6379
+"""
+import fnmatch
+import logging
+import random
+import SocketServer
+import threading
+import time
+
+from collections import defaultdict
+from optparse import OptionParser
+
+
+class CommandError(Exception):
+    pass
+
+
+def constant(seconds):
+    return lambda rnd: seconds
+
+
+def uniform(low, high):
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def exponential(mean):
+    return lambda rnd: rnd.expovariate(1.0 / mean)
+
+
+class FaultPlan(object):
+    """
+    Describes how the server misbehaves.
+    `latency` maps command name to distribution which
+    returns delay in seconds (see `constant`, `uniform`, `exponential`),
+    `drop` and `disconnect` map command name to probability of
+    keeping reply unsent or closing connection without reply.
+    Key `*` matches any command. Random generator is seeded
+    so the same sequence of commands gives the same faults.
+    """
+    def __init__(self, latency=None, drop=None, disconnect=None, seed=0):
+        self.latency = latency or {}
+        self.drop = drop or {}
+        self.disconnect = disconnect or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _lookup(mapping, command):
+        return mapping.get(command, mapping.get("*"))
+
+    def decide(self, command):
+        """ Return tuple (delay, action) where action is None, 'drop' or 'disconnect' """
+        with self.lock:
+            distribution = self._lookup(self.latency, command)
+            delay = distribution(self.random) if distribution else 0
+            action = None
+            for name, mapping in (("disconnect", self.disconnect), ("drop", self.drop)):
+                probability = self._lookup(mapping, command)
+                if probability and self.random.random() < probability:
+                    action = name
+                    break
+        return delay, action
+
+
+class Storage(object):
+    """ Key-value storage with expiration, `clock` can be replaced in tests """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+        # reported by INFO replication, change it to emulate a replica
+        self.replication = {"role": "master"}
+        self.lock = threading.Lock()
+
+    def _alive(self, key):
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= self.clock():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        if ex is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = self.clock() + ex
+
+    def delete(self, key):
+        existed = self._alive(key)
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+        return existed
+
+    def ttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(round(self.expires[key] - self.clock()))
+
+    def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self.expires[key] = self.clock() + seconds
+        return True
+
+
+class Commands(object):
+    """ Implementation of supported commands, each returns python value to encode """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __call__(self, name, args):
+        handler = getattr(self, "cmd_" + name.lower(), None)
+        if handler is None:
+            raise CommandError("ERR unknown command '%s'" % name)
+        with self.storage.lock:
+            return handler(*args)
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else Status("PONG")
+
+    def cmd_echo(self, message):
+        return message
+
+    def cmd_select(self, db):
+        return Status("OK")
+
+    def cmd_get(self, key):
+        return self.storage.get(key)
+
+    def cmd_mget(self, *keys):
+        return [self.storage.get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        ex = None
+        if "EX" in options:
+            ex = int(options[options.index("EX") + 1])
+        elif "PX" in options:
+            ex = int(options[options.index("PX") + 1]) / 1000.0
+        exists = self.storage.get(key) is not None
+        if ("NX" in options and exists) or ("XX" in options and not exists):
+            return None
+        self.storage.set(key, value, ex)
+        return Status("OK")
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.storage.get(key) or 0) + int(amount)
+        self.storage.data[key] = str(value)
+        return value
+
+    def cmd_del(self, *keys):
+        return sum(1 for key in keys if self.storage.delete(key))
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.storage.get(key) is not None)
+
+    def cmd_expire(self, key, seconds):
+        return int(self.storage.expire(key, int(seconds)))
+
+    def cmd_ttl(self, key):
+        return self.storage.ttl(key)
+
+    def cmd_scan(self, cursor, *options):
+        options = [option.upper() if i % 2 == 0 else option for i, option in enumerate(options)]
+        match = options[options.index("MATCH") + 1] if "MATCH" in options else "*"
+        count = int(options[options.index("COUNT") + 1]) if "COUNT" in options else 10
+        keys = sorted(key for key in self.storage.data.keys() if self.storage.get(key) is not None)
+        start = int(cursor)
+        next_cursor = start + count if start + count < len(keys) else 0
+        return [str(next_cursor), [key for key in keys[start:start + count] if fnmatch.fnmatchcase(key, match)]]
+
+    def cmd_info(self, section=None):
+        lines = ["# Replication"] + ["%s:%s" % item for item in sorted(self.storage.replication.items())]
+        return "\r\n".join(lines) + "\r\n"
+
+    def cmd_flushdb(self):
+        self.storage.data.clear()
+        self.storage.expires.clear()
+        return Status("OK")
+
+
+class Status(str):
+    """ Simple string reply like +OK """
+
+
+def encode(value):
+    if isinstance(value, Status):
+        return "+%s\r\n" % value
+    if isinstance(value, CommandError):
+        return "-%s\r\n" % value
+    if value is None:
+        return "$-1\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, long)):
+        return ":%d\r\n" % value
+    if isinstance(value, (list, tuple)):
+        return "*%d\r\n%s" % (len(value), "".join(encode(item) for item in value))
+    value = str(value)
+    return "$%d\r\n%s\r\n" % (len(value), value)
+
+
+class RespHandler(SocketServer.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith("*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        transaction = None
+        while True:
+            args = self.read_command()
+            if not args:
+                return
+            name = args[0].upper()
+            server.stats[name] += 1
+            delay, action = server.faults.decide(name)
+            if delay:
+                time.sleep(delay)
+            if action == "disconnect":
+                return
+            if name == "MULTI":
+                transaction, reply = [], Status("OK")
+            elif name == "EXEC":
+                reply = [self.execute(*queued) for queued in transaction or []]
+                transaction = None
+            elif name == "DISCARD":
+                transaction, reply = None, Status("OK")
+            elif transaction is not None:
+                transaction.append((name, args[1:]))
+                reply = Status("QUEUED")
+            else:
+                reply = self.execute(name, args[1:])
+            if action == "drop":
+                continue
+            self.wfile.write(encode(reply))
+            self.wfile.flush()
+
+    def execute(self, name, args):
+        try:
+            return self.server.commands(name, args)
+        except (CommandError, TypeError, ValueError, IndexError) as e:
+            return e if isinstance(e, CommandError) else CommandError("ERR %s" % e)
+
+
+class RespServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None, clock=time.time):
+        SocketServer.TCPServer.__init__(self, (host, port), RespHandler)
+        self.faults = faults or FaultPlan()
+        self.storage = Storage(clock)
+        self.commands = Commands(self.storage)
+        self.stats = defaultdict(int)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    server = RespServer(port=opts.port)
+    logging.info("Starting RESP server at %s" % opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -2,7 +2,8 @@ import hashlib
 import json
 
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None,
+              deadline=None):
     key_parts = [
         first_name or "",
         last_name or "",
@@ -11,7 +12,7 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
+    score = store.cache_get(key, deadline=deadline) or 0
     if score:
         return score
     if phone:
@@ -23,10 +24,30 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     if first_name and last_name:
         score += 0.5
     # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
+    store.cache_set(key, score,  60 * 60, deadline=deadline)
     return score
 
 
-def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+def get_interests(store, cid, deadline=None):
+    r = store.get("i:%s" % cid, deadline=deadline)
     return json.loads(r) if r else []
+
+
+def get_raw_interests_many(store, cids, deadline=None):
+    return store.get_many(["i:%s" % cid for cid in cids], deadline=deadline)
+
+
+def decode_interests(values):
+    return [json.loads(r) if r else [] for r in values]
+
+
+def get_interests_many(store, cids, deadline=None):
+    return decode_interests(get_raw_interests_many(store, cids, deadline))
+
+
+def interests_etag(cids, values):
+    """ Version of interests of clients, it changes when any stored value changes """
+    digest = hashlib.md5()
+    for cid, value in zip(cids, values):
+        digest.update("%s:%d:%s\n" % (cid, len(value or ""), value or ""))
+    return '"%s"' % digest.hexdigest()
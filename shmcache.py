@@ -0,0 +1,291 @@
+import errno
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+# File header: magic, version, buckets, ways, key size, value size
+HEADER = struct.Struct("<4sIIIII")
+MAGIC = "SHMC"
+VERSION = 2
+# Bucket header: sequence number of the seqlock, clock hand
+BUCKET_HEADER = struct.Struct("<IB")
+# Slot header: used flag, clock reference bit, key length, value length, expiration time, hits
+SLOT_HEADER = struct.Struct("<BBHHdI")
+HITS = struct.Struct("<I")
+HITS_OFFSET = SLOT_HEADER.size - HITS.size
+WAYS = 8
+KEY_SIZE = 64
+VALUE_SIZE = 256
+DEFAULT_BUCKETS = 4096
+DEFAULT_STRIPES = 64
+DEFAULT_TTL = 60   # in seconds
+# Attempts of lock-free read before reading under lock
+READ_RETRIES = 3
+
+
+class SharedMemoryCache(object):
+    """
+    Fixed-size hash table in memory mapped file which is
+    shared by all processes on the host opening the same `path`.
+
+    The table is split into buckets of `WAYS` slots, a key lives in
+    the bucket chosen by its hash. Values have expiration time
+    and when bucket is full a victim is chosen by CLOCK algorithm.
+    Writers take one of `stripes` locks (thread lock plus `fcntl`
+    byte-range lock for other processes), readers don't take locks
+    and use sequence number of the bucket to detect concurrent writes.
+    Keys and values which don't fit the slot are not cached.
+    """
+    def __init__(self, path, buckets=DEFAULT_BUCKETS, stripes=DEFAULT_STRIPES, clock=time.time):
+        self.path = path
+        self.buckets = buckets
+        self.stripes = stripes
+        self.clock = clock
+        self.slot_size = SLOT_HEADER.size + KEY_SIZE + VALUE_SIZE
+        self.bucket_size = BUCKET_HEADER.size + WAYS * self.slot_size
+        self.size = HEADER.size + buckets * self.bucket_size
+        self.header = HEADER.pack(MAGIC, VERSION, buckets, WAYS, KEY_SIZE, VALUE_SIZE)
+        self.fd = self._open()
+        self.mmap = mmap.mmap(self.fd, self.size)
+        self.thread_locks = [threading.Lock() for _ in range(stripes)]
+
+    def _open(self):
+        """
+        Open the table file, if it's missing or has another layout a new empty
+        table is created under a temporary name and renamed into place.
+        The old file is never truncated: processes which mapped it keep using it.
+        """
+        lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # only one process at a time replaces the file, so they all open the same one
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX)
+            try:
+                fd = os.open(self.path, os.O_RDWR)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                if os.read(fd, HEADER.size) == self.header and os.fstat(fd).st_size == self.size:
+                    return fd
+                os.close(fd)
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, self.size)
+                os.write(fd, self.header)
+                os.rename(tmp_path, self.path)
+            except OSError:
+                os.close(fd)
+                os.unlink(tmp_path)
+                raise
+            return fd
+        finally:
+            os.close(lock_fd)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+    @staticmethod
+    def _encode(value):
+        return value.encode("utf-8") if isinstance(value, unicode) else str(value)
+
+    def _bucket(self, key):
+        index = (zlib.crc32(key) & 0xffffffff) % self.buckets
+        return index, HEADER.size + index * self.bucket_size
+
+    @contextmanager
+    def _lock(self, index):
+        stripe = index % self.stripes
+        with self.thread_locks[stripe]:
+            # lock bytes out of the header, it doesn't matter if they are in the file
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.size + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.size + stripe)
+
+    def _slots(self, bucket):
+        start = bucket + BUCKET_HEADER.size
+        return range(start, start + WAYS * self.slot_size, self.slot_size)
+
+    def _find(self, bucket, key):
+        """ Return tuple (slot offset, value, expiration time) or None """
+        for slot in self._slots(bucket):
+            used, ref, key_len, value_len, expires_at, hits = SLOT_HEADER.unpack_from(self.mmap, slot)
+            if not used or key_len != len(key):
+                continue
+            key_start = slot + SLOT_HEADER.size
+            if self.mmap[key_start:key_start + key_len] == key:
+                value_start = key_start + KEY_SIZE
+                return slot, self.mmap[value_start:value_start + value_len], expires_at
+        return None
+
+    def _write_begin(self, bucket):
+        seq, hand = BUCKET_HEADER.unpack_from(self.mmap, bucket)
+        BUCKET_HEADER.pack_into(self.mmap, bucket, seq + 1, hand)
+        return hand
+
+    def _write_end(self, bucket, hand):
+        seq = BUCKET_HEADER.unpack_from(self.mmap, bucket)[0]
+        BUCKET_HEADER.pack_into(self.mmap, bucket, (seq + 1) & 0xffffffff, hand)
+
+    def get(self, key):
+        key = self._encode(key)
+        index, bucket = self._bucket(key)
+        for _ in range(READ_RETRIES):
+            seq = BUCKET_HEADER.unpack_from(self.mmap, bucket)[0]
+            if seq & 1:
+                continue
+            found = self._find(bucket, key)
+            if BUCKET_HEADER.unpack_from(self.mmap, bucket)[0] == seq:
+                break
+        else:
+            with self._lock(index):
+                found = self._find(bucket, key)
+        if found is None:
+            return None
+        slot, value, expires_at = found
+        if expires_at <= self.clock():
+            return None
+        # the reference bit and hits are hints so they are updated without lock
+        self.mmap[slot + 1] = "\x01"
+        hits = HITS.unpack_from(self.mmap, slot + HITS_OFFSET)[0]
+        HITS.pack_into(self.mmap, slot + HITS_OFFSET, min(hits + 1, 0xffffffff))
+        return value
+
+    def _victim(self, bucket, hand, now):
+        """ Return (slot offset, new clock hand) for a new value """
+        slots = self._slots(bucket)
+        for slot in slots:
+            used, ref, key_len, value_len, expires_at, hits = SLOT_HEADER.unpack_from(self.mmap, slot)
+            if not used or expires_at <= now:
+                return slot, hand
+        while True:
+            slot = slots[hand]
+            hand = (hand + 1) % WAYS
+            if self.mmap[slot + 1] == "\x00":
+                return slot, hand
+            self.mmap[slot + 1] = "\x00"
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        """ Save value for `ttl` seconds, returns False if it's too big to be cached """
+        key, value = self._encode(key), self._encode(value)
+        if len(key) > KEY_SIZE:
+            return False
+        if len(value) > VALUE_SIZE:
+            # don't leave the previous value of the key
+            self.delete(key)
+            return False
+        index, bucket = self._bucket(key)
+        now = self.clock()
+        with self._lock(index):
+            hand = self._write_begin(bucket)
+            try:
+                found = self._find(bucket, key)
+                if found is not None:
+                    slot = found[0]
+                    hits = HITS.unpack_from(self.mmap, slot + HITS_OFFSET)[0]
+                else:
+                    slot, hand = self._victim(bucket, hand, now)
+                    hits = 0
+                SLOT_HEADER.pack_into(self.mmap, slot, 1, 1, len(key), len(value), now + ttl, hits)
+                key_start = slot + SLOT_HEADER.size
+                self.mmap[key_start:key_start + len(key)] = key
+                self.mmap[key_start + KEY_SIZE:key_start + KEY_SIZE + len(value)] = value
+            finally:
+                self._write_end(bucket, hand)
+        return True
+
+    def delete(self, key):
+        key = self._encode(key)
+        index, bucket = self._bucket(key)
+        with self._lock(index):
+            hand = self._write_begin(bucket)
+            try:
+                found = self._find(bucket, key)
+                if found is not None:
+                    self.mmap[found[0]] = "\x00"
+            finally:
+                self._write_end(bucket, hand)
+
+    def items(self):
+        """
+        Iterate over (key, value, expiration time, hits) of alive values.
+        It doesn't take locks so a value changed meanwhile can be skipped
+        """
+        now = self.clock()
+        for index in xrange(self.buckets):
+            for slot in self._slots(HEADER.size + index * self.bucket_size):
+                used, ref, key_len, value_len, expires_at, hits = SLOT_HEADER.unpack_from(self.mmap, slot)
+                if not used or expires_at <= now:
+                    continue
+                key_start = slot + SLOT_HEADER.size
+                value_start = key_start + KEY_SIZE
+                yield (self.mmap[key_start:key_start + key_len],
+                       self.mmap[value_start:value_start + value_len], expires_at, hits)
+
+    def hottest(self, limit):
+        """ Return `limit` alive values with the most hits as tuples like `items` """
+        return heapq.nlargest(limit, self.items(), key=lambda item: item[3])
+
+
+class TieredCache(object):
+    """
+    Store which serves values from shared memory cache `l1`
+    and goes to `store` (`store.RedisCache`) only on miss.
+    Values received from the store are kept in `l1` for `ttl` seconds.
+    """
+    def __init__(self, l1, store, ttl=DEFAULT_TTL):
+        self.l1 = l1
+        self.store = store
+        self.ttl = ttl
+
+    def _get(self, key, fetch, deadline):
+        value = self.l1.get(key)
+        if value is None:
+            value = fetch(key, deadline=deadline)
+            if value is not None:
+                self.l1.set(key, value, self.ttl)
+        return value
+
+    def _get_many(self, keys, fetch, deadline):
+        values = [self.l1.get(key) for key in keys]
+        missing = [index for index, value in enumerate(values) if value is None]
+        if missing:
+            for index, value in zip(missing, fetch([keys[i] for i in missing], deadline=deadline)):
+                values[index] = value
+                if value is not None:
+                    self.l1.set(keys[index], value, self.ttl)
+        return values
+
+    def cache_get(self, key, deadline=None):
+        return self._get(key, self.store.cache_get, deadline)
+
+    def cache_get_many(self, keys, deadline=None):
+        return self._get_many(keys, self.store.cache_get_many, deadline)
+
+    def cache_set(self, key, value, expired=None, deadline=None):
+        self.store.cache_set(key, value, expired, deadline=deadline)
+        self.l1.set(key, value, min(expired, self.ttl) if expired else self.ttl)
+
+    def get(self, key, deadline=None):
+        return self._get(key, self.store.get, deadline)
+
+    def get_many(self, keys, deadline=None):
+        return self._get_many(keys, self.store.get_many, deadline)
+
+    def set(self, key, value, deadline=None):
+        self.store.set(key, value, deadline=deadline)
+        self.l1.set(key, value, self.ttl)
+
+    def delete(self, key, deadline=None):
+        self.store.delete(key, deadline=deadline)
+        self.l1.delete(key)
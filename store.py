@@ -1,8 +1,14 @@
+import bisect
+import hashlib
+import keytrace
 import redis
 import logging
+import random
+import struct
+import threading
 import time
 
-from functools import wraps
+from hotkeys import hot_keys
 
 # Example of Redis config
 REDIS_CONFIG = {
@@ -13,6 +19,29 @@ REDIS_CONFIG = {
     "SLEEP_TIMEOUT": 3,   # in seconds
     "SOCKET_TIMEOUT": 5,
 }
+# Keys are sharded between nodes if config has "NODES" list, e.g.:
+# "NODES": [{"HOST": "redis1", "PORT": 6379}, {"HOST": "redis2", "PORT": 6379}]
+DEFAULT_VNODES = 160
+# Failures in a row after which node is considered down
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_DOWN_TIMEOUT = 10   # in seconds
+# Reads go to replicas if a node has "REPLICAS" list, e.g.:
+# "REPLICAS": [{"HOST": "redis-replica1", "PORT": 6379}]
+# Replica which is behind primary more than this is not used for reads
+DEFAULT_MAX_REPLICA_LAG = 5   # in seconds
+DEFAULT_REPLICA_CHECK_INTERVAL = 5   # in seconds
+# Weight of the last response time in the replica latency average
+LATENCY_DECAY = 0.2
+# Concurrent single-key reads are sent as one MGET if config has "BATCH_WINDOW"
+# (in seconds), batch is sent earlier when it has "BATCH_MAX_KEYS" keys
+DEFAULT_BATCH_MAX_KEYS = 64
+# Reads are counted in `hotkeys.hot_keys` unless "TRACK_HOT_KEYS" is False
+# Reads, writes and deletes of keys are appended to "TRACE_PATH" file if it's set,
+# the trace is replayed by `cachesim.py`
+TRACED_COMMANDS = {"set": keytrace.WRITE, "delete": keytrace.DELETE}
+
+# Deadline of the current call in the thread, see `DeadlineConnection`
+call_deadline = threading.local()
 
 
 def get_log():
@@ -25,31 +54,217 @@ def get_log():
     return logger
 
 
-def ensure_connection(method):
-    @wraps(method)
-    def wrapper(self, *args, **kwargs):
-        if self.conn is None:
-            attempts = self.config["ATTEMPTS"]
-            while True:
-                self.conn = redis.StrictRedis(
-                    host=self.config["HOST"],
-                    port=self.config["PORT"],
-                    db=self.config["DB"],
-                    socket_timeout=self.config["SOCKET_TIMEOUT"]
-                )
-                try:
-                    self.conn.ping()
-                    break
-                except redis.ConnectionError, redis.TimeoutError:
-                    time.sleep(self.config["SLEEP_TIMEOUT"])
-                if attempts == -1 or attempts is None:
-                    continue
-                elif isinstance(attempts, int) and attempts > 0:
-                    attempts -= 1
-                else:
-                    break
-        return method(self, *args, **kwargs)
-    return wrapper
+class DeadlineExceeded(Exception):
+    """ Time of the request is over, the work should be abandoned """
+
+
+def remaining_time(deadline):
+    """ Seconds left until deadline (time in seconds since the epoch), raises if none """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    return remaining
+
+
+class DeadlineConnection(redis.Connection):
+    """
+    Connection which limits connect, send and read by the time left until
+    deadline of the current call (`call_deadline.value`) if it's set,
+    so retries of redis-py can't outlive the deadline. When no time is left
+    DeadlineExceeded is raised and the connection is closed.
+    """
+    def _call_timeout(self):
+        deadline = getattr(call_deadline, "value", None)
+        if deadline is None:
+            return self.socket_timeout
+        try:
+            remaining = remaining_time(deadline)
+        except DeadlineExceeded:
+            self.disconnect()
+            raise
+        return min(remaining, self.socket_timeout) if self.socket_timeout is not None else remaining
+
+    def _apply_call_timeout(self):
+        timeout = self._call_timeout()
+        if self._sock is not None:
+            self._sock.settimeout(timeout)
+        return timeout
+
+    def connect(self):
+        connect_timeout = self.socket_connect_timeout
+        if getattr(call_deadline, "value", None) is not None:
+            self.socket_connect_timeout = self._call_timeout()
+        try:
+            super(DeadlineConnection, self).connect()
+        finally:
+            self.socket_connect_timeout = connect_timeout
+
+    def send_packed_command(self, command):
+        if not self._sock:
+            self.connect()
+        self._apply_call_timeout()
+        super(DeadlineConnection, self).send_packed_command(command)
+
+    def read_response(self):
+        timeout = self._apply_call_timeout()
+        try:
+            return super(DeadlineConnection, self).read_response()
+        except redis.TimeoutError:
+            # the socket may time out a bit before the deadline, it's rounded to milliseconds
+            if timeout != self.socket_timeout:
+                raise DeadlineExceeded("Deadline exceeded while waiting for Redis")
+            raise
+
+
+def node_name(node):
+    return "%s:%s" % (node["HOST"], node["PORT"])
+
+
+class HashRing(object):
+    """
+    Consistent hashing ring with virtual nodes.
+    Every node is placed on the ring `vnodes` times so keys
+    are spread evenly and adding a node moves only
+    the keys which the new node takes from others.
+    """
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.hashes = []
+        self.owners = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(value):
+        return struct.unpack(">Q", hashlib.md5(value).digest()[:8])[0]
+
+    @property
+    def nodes(self):
+        return set(self.owners.values())
+
+    def add_node(self, node):
+        for i in range(self.vnodes):
+            point = self.hash("%s#%d" % (node, i))
+            if point not in self.owners:
+                bisect.insort(self.hashes, point)
+            self.owners[point] = node
+
+    def remove_node(self, node):
+        for i in range(self.vnodes):
+            point = self.hash("%s#%d" % (node, i))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.hashes.remove(point)
+
+    def get_node(self, key):
+        if not self.hashes:
+            raise ValueError("Hash ring is empty")
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[self.hashes[index]]
+
+
+class NodeHealth(object):
+    """
+    Health of a single node. After `threshold` failures in a row
+    or failed connection attempts the node is down for `down_timeout`
+    seconds: commands fail fast and connection retries are skipped.
+    When the timeout is over the next command checks the node again.
+    """
+    def __init__(self, threshold=DEFAULT_FAILURE_THRESHOLD, down_timeout=DEFAULT_DOWN_TIMEOUT):
+        self.threshold = threshold
+        self.down_timeout = down_timeout
+        self.failures = 0
+        self.down_until = 0
+
+    def is_down(self):
+        return self.down_until > time.time()
+
+    def down(self):
+        self.down_until = time.time() + self.down_timeout
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.down()
+
+    def success(self):
+        self.failures = 0
+        self.down_until = 0
+
+
+class Replica(object):
+    """ Read replica of a node with moving average of its response time """
+    def __init__(self, name):
+        self.name = name
+        self.latency = 0.0
+        self.lagging = False
+        self.checked_at = 0
+
+    def observe(self, elapsed):
+        self.latency += LATENCY_DECAY * (elapsed - self.latency)
+
+
+class Batch(object):
+    def __init__(self):
+        self.keys = []
+        self.indexes = {}
+        self.values = None
+        self.error = None
+        # the latest deadline of readers, None if one of them has no deadline
+        self.deadline = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GetBatcher(object):
+    """
+    Collects keys requested by concurrent threads during `window`
+    seconds or until there are `max_keys` keys and receives them
+    with one call of `get_many`. The first thread of a batch waits
+    for the window and makes the call, the others wait for its result.
+    """
+    def __init__(self, get_many, window, max_keys=DEFAULT_BATCH_MAX_KEYS):
+        self.get_many = get_many
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def get(self, key, deadline=None):
+        with self.lock:
+            batch, is_leader = self.batch, self.batch is None
+            if is_leader:
+                batch = self.batch = Batch()
+            if deadline is None or batch.deadline is None:
+                batch.deadline = None
+            else:
+                batch.deadline = max(batch.deadline, deadline)
+            if key not in batch.indexes:
+                batch.indexes[key] = len(batch.keys)
+                batch.keys.append(key)
+            if len(batch.keys) >= self.max_keys:
+                self.batch = None
+                batch.full.set()
+        if is_leader:
+            # the batch is always detached and completed, otherwise next reads would wait for it forever
+            try:
+                batch.full.wait(self.window if deadline is None else
+                                max(0, min(self.window, deadline - time.time())))
+            finally:
+                with self.lock:
+                    if self.batch is batch:
+                        self.batch = None
+            try:
+                batch.values = self.get_many(batch.keys, deadline=batch.deadline)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        elif not batch.done.wait(None if deadline is None else remaining_time(deadline)):
+            raise DeadlineExceeded("Deadline exceeded while waiting for batch")
+        if batch.error is not None:
+            raise batch.error
+        return batch.values[batch.indexes[key]]
 
 
 class RedisCache(object):
@@ -59,53 +274,304 @@ class RedisCache(object):
         self.config = config
 
         self.log = log if log else get_log()
-        self.conn = None
+        self.nodes = {}
+        self.conns = {}
+        self.health = {}
+        self.replicas = {}
+        self.replica_names = set()
+        self.ring = HashRing(vnodes=config.get("VNODES", DEFAULT_VNODES))
+        for node in config.get("NODES") or [config]:
+            self.add_node(node)
+        self.default_node = node_name(config["NODES"][0] if config.get("NODES") else config)
+        self.get_batcher = self.cache_get_batcher = None
+        if config.get("BATCH_WINDOW"):
+            max_keys = config.get("BATCH_MAX_KEYS", DEFAULT_BATCH_MAX_KEYS)
+            self.get_batcher = GetBatcher(self._mget, config["BATCH_WINDOW"], max_keys)
+            self.cache_get_batcher = GetBatcher(self.cache_get_many, config["BATCH_WINDOW"], max_keys)
+        self.hot_keys = hot_keys if config.get("TRACK_HOT_KEYS", True) else None
+        self.trace = keytrace.TraceWriter(config["TRACE_PATH"]) if config.get("TRACE_PATH") else None
 
-    def connect(self):
-        self.conn = redis.StrictRedis(
-            host=self.config["HOST"],
-            port=self.config["PORT"],
+    @property
+    def conn(self):
+        """ Connection to the first node """
+        return self.conns.get(self.default_node)
+
+    @conn.setter
+    def conn(self, value):
+        self.conns[self.default_node] = value
+
+    def add_node(self, node):
+        """
+        Add node with "HOST" and "PORT" to the ring,
+        only keys which the node takes from others are moved
+        """
+        name = self._add_connection(node)
+        self.replicas[name] = [Replica(self._add_connection(replica))
+                               for replica in node.get("REPLICAS") or []]
+        self.replica_names.update(replica.name for replica in self.replicas[name])
+        self.ring.add_node(name)
+
+    def _add_connection(self, node):
+        name = node_name(node)
+        self.nodes[name] = node
+        self.conns[name] = None
+        self.health[name] = NodeHealth(
+            self.config.get("FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD),
+            self.config.get("DOWN_TIMEOUT", DEFAULT_DOWN_TIMEOUT)
+        )
+        return name
+
+    def _make_conn(self, name):
+        return redis.StrictRedis(connection_pool=redis.ConnectionPool(
+            connection_class=DeadlineConnection,
+            host=self.nodes[name]["HOST"],
+            port=self.nodes[name]["PORT"],
             db=self.config["DB"],
             socket_timeout=self.config["SOCKET_TIMEOUT"]
-        )
+        ))
+
+    def connect(self):
+        for name in self.nodes:
+            self.conns[name] = self._make_conn(name)
         return self
 
-    @ensure_connection
-    def cache_get(self, key):
+    def _ensure_connection(self, name, deadline=None):
+        """
+        Return connection to the node, if there is no connection
+        it's made with `ATTEMPTS` attempts. Attempts are skipped
+        while the node is down, for replicas because reads fall back
+        to primary and when there is no time left before `deadline`.
+        """
+        if self.conns[name] is not None:
+            return self.conns[name]
+        health = self.health[name]
+        attempts = self.config["ATTEMPTS"]
+        while True:
+            self.conns[name] = self._make_conn(name)
+            try:
+                self.conns[name].ping()
+                health.success()
+                break
+            except (redis.ConnectionError, redis.TimeoutError):
+                if health.is_down():
+                    break
+                if name in self.replica_names:
+                    health.down()
+                    break
+                if deadline is not None and time.time() + self.config["SLEEP_TIMEOUT"] >= deadline:
+                    break
+                time.sleep(self.config["SLEEP_TIMEOUT"])
+            if attempts == -1 or attempts is None:
+                continue
+            elif isinstance(attempts, int) and attempts > 0:
+                attempts -= 1
+            else:
+                health.down()
+                break
+        return self.conns[name]
+
+    def _execute(self, name, command, *args, **kwargs):
+        """
+        Run command on the node and track the node health,
+        `command` is a name of connection method or function of connection.
+        If `deadline` is given the remaining time limits socket operations.
+        """
+        deadline = kwargs.pop("deadline", None)
+        health = self.health[name]
+        if health.is_down() and self.conns[name] is not None:
+            raise redis.ConnectionError("Redis node %s is down" % name)
+        if deadline is not None:
+            remaining_time(deadline)
+            call_deadline.value = deadline
+        try:
+            conn = self._ensure_connection(name, deadline)
+            if callable(command):
+                result = command(conn, *args, **kwargs)
+            else:
+                result = getattr(conn, command)(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            if deadline is not None and deadline <= time.time():
+                raise DeadlineExceeded("Deadline exceeded while waiting for Redis node %s" % name)
+            health.failure()
+            raise
+        finally:
+            call_deadline.value = None
+        health.success()
+        return result
+
+    def _is_lagging(self, replica, deadline=None):
+        """ Check replication state of the replica once in `REPLICA_CHECK_INTERVAL` """
+        now = time.time()
+        if now - replica.checked_at < self.config.get("REPLICA_CHECK_INTERVAL",
+                                                      DEFAULT_REPLICA_CHECK_INTERVAL):
+            return replica.lagging
+        replica.checked_at = now
+        try:
+            info = self._execute(replica.name, "info", "replication", deadline=deadline)
+        except (redis.ConnectionError, redis.TimeoutError):
+            replica.lagging = True
+            return replica.lagging
+        max_lag = self.config.get("MAX_REPLICA_LAG", DEFAULT_MAX_REPLICA_LAG)
+        replica.lagging = (info.get("master_link_status") != "up"
+                           or info.get("master_last_io_seconds_ago", 0) > max_lag)
+        if replica.lagging:
+            self.log.error("Replica %s is lagging, reading from primary", replica.name)
+        return replica.lagging
+
+    def _choose_replica(self, name, deadline=None):
+        """
+        Choose the faster of two random healthy replicas of the node
+        so load is spread but slow replicas get less requests
+        """
+        candidates = [replica for replica in self.replicas[name]
+                      if not self.health[replica.name].is_down() and not self._is_lagging(replica, deadline)]
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda replica: replica.latency) if candidates else None
+
+    def _read(self, name, command, *args, **kwargs):
+        """ Run read-only command on a replica of the node, the node itself is a fallback """
+        replica = self._choose_replica(name, kwargs.get("deadline"))
+        if replica is not None:
+            started = time.time()
+            try:
+                result = self._execute(replica.name, command, *args, **kwargs)
+                replica.observe(time.time() - started)
+                return result
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.log.error("Replica %s is down, reading from primary", replica.name)
+        return self._execute(name, command, *args, **kwargs)
+
+    def _record_reads(self, keys):
+        if self.hot_keys is not None:
+            self.hot_keys.add_many(keys)
+        if self.trace is not None:
+            self.trace.record_many(keys, keytrace.READ)
+
+    def _execute_by_key(self, key, command, *args, **kwargs):
+        if self.trace is not None and command in TRACED_COMMANDS:
+            self.trace.record(key, TRACED_COMMANDS[command])
+        return self._execute(self.ring.get_node(key), command, key, *args, **kwargs)
+
+    def _read_by_key(self, key, command, *args, **kwargs):
+        self._record_reads([key])
+        return self._read(self.ring.get_node(key), command, key, *args, **kwargs)
+
+    def _mget(self, keys, ignore_errors=False, deadline=None):
+        """
+        Get values by keys with one MGET per node,
+        nodes are requested concurrently
+        """
+        self._record_reads(keys)
+        indexes_by_node = {}
+        for index, key in enumerate(keys):
+            indexes_by_node.setdefault(self.ring.get_node(key), []).append(index)
+
+        def mget_node(item):
+            name, indexes = item
+            try:
+                return indexes, self._read(name, "mget", [keys[i] for i in indexes], deadline=deadline)
+            except (redis.ConnectionError, redis.TimeoutError):
+                if not ignore_errors:
+                    raise
+                self.log.error("Error on receiving keys from %s. Redis is down.", name)
+                return indexes, [None] * len(indexes)
+
+        # the first node is requested in this thread and the others in threads of this call,
+        # so a slow node doesn't hold reads of other requests and deadline limits the whole call
+        items = indexes_by_node.items()
+        results = [None] * len(items)
+        errors = []
+
+        def run(position, item):
+            try:
+                results[position] = mget_node(item)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(position, item))
+                   for position, item in enumerate(items[1:], 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        if items:
+            run(0, items[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        values = [None] * len(keys)
+        for indexes, node_values in results:
+            for index, value in zip(indexes, node_values):
+                values[index] = value
+        return values
+
+    def cache_get(self, key, deadline=None):
         """
         Get value with key firstly from Redis
         but if it fails then from local cache
         """
+        if self.cache_get_batcher is not None:
+            return self.cache_get_batcher.get(key, deadline)
         try:
-            value = self.conn.get(key)
-        except redis.ConnectionError:
+            value = self._read_by_key(key, "get", deadline=deadline)
+        except (redis.ConnectionError, redis.TimeoutError):
             self.log.error("Redis is down. Please reload Redis sever")
             value = None
 
         return value
 
-    @ensure_connection
-    def cache_set(self, key, value, expired=None):
+    def cache_get_many(self, keys, deadline=None):
+        """ Same as `cache_get` for several keys, keys of failed nodes are None """
+        return self._mget(keys, ignore_errors=True, deadline=deadline)
+
+    def cache_set(self, key, value, expired=None, deadline=None):
         try:
-            self.conn.set(key, value, ex=expired)
-        except redis.ConnectionError:
+            self._execute_by_key(key, "set", value, ex=expired, deadline=deadline)
+        except (redis.ConnectionError, redis.TimeoutError):
             self.log.error("Error on setting key: %s with value: %s. "
                            "Redis is down.", key, value)
 
-    @ensure_connection
-    def get(self, key):
+    def get(self, key, deadline=None):
         """ Retrive value from Redis """
         self.log.info("receiving value by key: %s from Redis", key)
-        return self.conn.get(key)
+        if self.get_batcher is not None:
+            return self.get_batcher.get(key, deadline)
+        return self._read_by_key(key, "get", deadline=deadline)
+
+    def get_many(self, keys, deadline=None):
+        """ Retrive values of several keys from Redis """
+        self.log.info("receiving values by keys: %s from Redis", keys)
+        return self._mget(keys, deadline=deadline)
 
-    @ensure_connection
-    def set(self, key, value):
+    def scan(self, match, limit, count=100):
+        """ Return up to `limit` keys matching the pattern, nodes are scanned in turn """
+        keys = []
+        for name in sorted(self.replicas):
+            cursor = 0
+            while len(keys) < limit:
+                cursor, node_keys = self._read(name, "scan", cursor, match=match, count=count)
+                keys.extend(node_keys)
+                if not cursor:
+                    break
+        return keys[:limit]
+
+    def set(self, key, value, deadline=None):
         """ Save value directly to Redis """
         self.log.info("saving value: %s with key: %s to Redis", value, key)
-        self.conn.set(key, value)
+        self._execute_by_key(key, "set", value, deadline=deadline)
+
+    def incr(self, key, expired=None):
+        """ Increment counter in Redis and return its new value """
+        def incr_with_expire(conn):
+            pipe = conn.pipeline(transaction=False)
+            pipe.incr(key)
+            if expired:
+                pipe.expire(key, expired)
+            return pipe.execute()[0]
+        return self._execute(self.ring.get_node(key), incr_with_expire)
 
-    @ensure_connection
-    def delete(self, key):
+    def delete(self, key, deadline=None):
         """ Delete key directly from Redis """
         self.log.info("delete key: %s from Redis", key)
-        self.conn.delete(key)
+        self._execute_by_key(key, "delete", deadline=deadline)
@@ -0,0 +1,35 @@
+import pytest
+
+from resp_server import RespServer
+from store import RedisCache, REDIS_CONFIG
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def resp_server(clock):
+    """ RESP server on a free port, keys in it expire by `clock` """
+    server = RespServer(clock=clock).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_store():
+    """ Factory of stores of RESP servers which don't sleep between connection attempts """
+    def make(server, **config):
+        store_config = dict(REDIS_CONFIG, PORT=server.port, SLEEP_TIMEOUT=0, SOCKET_TIMEOUT=0.2)
+        store_config.update(config)
+        return RedisCache(config=store_config)
+    return make
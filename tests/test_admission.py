@@ -0,0 +1,133 @@
+import hashlib
+import threading
+import time
+import pytest
+import requests
+
+import api
+from admission import (TokenBucket, LocalRateLimiter, RedisRateLimiter, ConcurrencyLimiter,
+                       AdmissionController, Overloaded, rate_limit_store_config)
+from metrics import Metrics
+from store import RedisCache
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [True, True, True, False] == [bucket.consume() for _ in range(4)]
+    clock.now += 0.5
+    assert [True, False] == [bucket.consume() for _ in range(2)]
+    clock.now += 100
+    assert 3 == sum(bucket.consume() for _ in range(10))
+
+
+def test_local_rate_limiter_per_key(clock):
+    limiter = LocalRateLimiter(rate=1, burst=1, max_buckets=2, clock=clock)
+    assert limiter.allow("acc/a")
+    assert not limiter.allow("acc/a")
+    assert limiter.allow("acc/b")
+    limiter.allow("acc/c")
+    assert 2 == len(limiter.buckets)
+
+
+def test_redis_rate_limiter_is_shared(resp_server, clock, make_store):
+    store = make_store(resp_server)
+    limiters = [RedisRateLimiter(store, rate=2, burst=1, clock=clock) for _ in range(2)]
+    assert [True, True, True, False] == [limiters[i % 2].allow("acc/a") for i in range(4)]
+    assert limiters[0].allow("acc/b")
+    clock.now += 1
+    assert limiters[1].allow("acc/a")
+
+
+def test_concurrency_limiter_queue():
+    limiter = ConcurrencyLimiter(max_active=1, max_queue=1, queue_timeout=1)
+    assert 0 == limiter.acquire()
+    queued = []
+    waiter = threading.Thread(target=lambda: queued.append(limiter.acquire()))
+    waiter.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    with pytest.raises(Overloaded):
+        limiter.acquire()
+    limiter.release()
+    waiter.join()
+    assert 1 == len(queued) and queued[0] > 0
+    limiter.queue_timeout = 0.01
+    with pytest.raises(Overloaded):
+        limiter.acquire()
+
+
+def test_admission_controller_sheds_and_counts(clock):
+    metrics = Metrics()
+    controller = AdmissionController(LocalRateLimiter(rate=1, burst=2, clock=clock),
+                                     ConcurrencyLimiter(max_active=1), metrics=metrics)
+    assert controller.admit("acc/login") is None
+    assert 503 == controller.admit("acc/login")
+    controller.release()
+    assert 429 == controller.admit("acc/login")
+    assert controller.admit("acc/other") is None
+    counters = metrics.snapshot()["counters"]
+    assert 2 == counters["admission.admitted"]
+    assert 1 == counters["admission.shed.overloaded"]
+    assert 1 == counters["admission.shed.rate_limited"]
+    assert 2 == metrics.snapshot()["histograms"]["admission.queue_time_ms"]["count"]
+
+
+def test_redis_rate_limiter_fails_fast_when_redis_is_down(resp_server, make_store):
+    store = RedisCache(config=rate_limit_store_config(make_store(resp_server).config))
+    resp_server.stop()
+    limiter = RedisRateLimiter(store, rate=1, burst=1)
+    started = time.time()
+    assert limiter.allow("acc/login")
+    assert limiter.allow("acc/login")
+    assert time.time() - started < 1
+
+
+@pytest.fixture
+def api_server(clock):
+    class Handler(api.MainHTTPHandler):
+        admission = AdmissionController(LocalRateLimiter(rate=1, burst=2, clock=clock),
+                                        ConcurrencyLimiter(max_active=1), metrics=Metrics())
+
+    server = api.ThreadedHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server, Handler.admission
+    server.shutdown()
+    server.server_close()
+
+
+def method_url(server):
+    return "http://%s:%s/method" % server.server_address
+
+
+def test_not_object_body_doesnt_release_concurrency_slot(api_server):
+    server, admission = api_server
+    for body in ("[1]", '"x"', "1"):
+        assert api.BAD_REQUEST == requests.post(method_url(server), data=body).status_code
+    assert 0 == admission.concurrency.active
+    assert api.FORBIDDEN == requests.post(method_url(server), json={
+        "account": "acc", "login": "login", "method": "online_score", "token": "", "arguments": {}}).status_code
+    assert 0 == admission.concurrency.active
+
+
+def test_unauthorized_requests_dont_spend_rate_of_login(api_server):
+    server, _ = api_server
+    body = {"account": "acc", "login": "victim", "method": "online_score", "token": "bogus", "arguments": {}}
+    codes = [requests.post(method_url(server), json=body).status_code for _ in range(3)]
+    assert [api.FORBIDDEN, api.FORBIDDEN, api.TOO_MANY_REQUESTS] == codes
+    body["token"] = hashlib.sha512("acc" + "victim" + api.SALT).hexdigest()
+    assert api.INVALID_REQUEST == requests.post(method_url(server), json=body).status_code
+
+
+def test_request_is_authorized_once(api_server, monkeypatch):
+    server, admission = api_server
+    calls = []
+    authorize = api.authorize
+    monkeypatch.setattr(api, "authorize", lambda body: calls.append(body) or authorize(body))
+    body = {"account": "acc", "login": "login", "method": "online_score", "token": "", "arguments": {}}
+    assert api.FORBIDDEN == requests.post(method_url(server), json=body).status_code
+    # without rate limiter the request is authorized only by the handler
+    admission.rate_limiter = None
+    assert api.FORBIDDEN == requests.post(method_url(server), json=body).status_code
+    assert 2 == len(calls)
@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+from cachesim import ARCCache, LFUCache, LRUCache, TinyLFUCache, POLICIES, Simulation, simulate
+from keytrace import READ, WRITE, DELETE
+
+
+def test_lru_evicts_least_recent():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert 1 == cache.get("a")
+    assert 3 == cache.get("c")
+
+
+def test_lfu_evicts_least_frequent():
+    cache = LFUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert 1 == cache.get("a")
+    cache.delete("c")
+    cache.set("d", 4)
+    cache.set("e", 5)
+    assert 1 == cache.get("a")
+
+
+def test_arc_keeps_frequent_keys_on_scan():
+    cache = ARCCache(10)
+    for _ in range(3):
+        for key in range(5):
+            if cache.get(key) is None:
+                cache.set(key, key)
+    for key in range(100, 200):
+        if cache.get(key) is None:
+            cache.set(key, key)
+    assert all(cache.get(key) == key for key in range(5))
+
+
+def test_tinylfu_doesnt_admit_one_hit_wonders():
+    cache = TinyLFUCache(100)
+    for _ in range(5):
+        for key in range(90):
+            if cache.get(key) is None:
+                cache.set(key, key)
+    for key in range(1000, 2000):
+        if cache.get(key) is None:
+            cache.set(key, key)
+    assert 85 <= sum(1 for key in range(90) if cache.get(key) is not None)
+
+
+@pytest.mark.parametrize("policy", list(POLICIES))
+def test_policies_respect_capacity(policy):
+    simulation = Simulation(policy, 50, 0)
+    rnd = random.Random(3)
+    for now in range(5000):
+        simulation.read("uid:%d" % int(rnd.paretovariate(1)), now)
+    cache = simulation.cache
+    resident = sum(1 for key in set("uid:%d" % i for i in range(10000)) if cache.get(key) is not None)
+    assert resident <= 50
+    assert 0 < simulation.hit_rate < 1
+
+
+def test_ttl_expires_values():
+    simulation = Simulation("lru", 10, 60)
+    simulation.read("uid:1", 1000)
+    simulation.read("uid:1", 1059)
+    simulation.read("uid:1", 1060)
+    simulation.read("uid:1", 1061)
+    assert (4, 2) == (simulation.reads, simulation.hits)
+
+
+def test_simulate_replays_events_for_all_caches():
+    events = [(1000, READ, "uid:1"), (1000, WRITE, "uid:1"), (1001, READ, "uid:1"),
+              (1002, DELETE, "uid:1"), (1003, READ, "uid:1"), (1004, READ, "uid:2")]
+    simulations = simulate(iter(events), ["lru", "arc"], [1, 10], [0, 60])
+    assert 8 == len(simulations)
+    for simulation in simulations:
+        assert (4, 1) == (simulation.reads, simulation.hits)
+
+
+def test_simulate_with_sampling():
+    events = [(1000, READ, "uid:%d" % (i % 100)) for i in range(10000)]
+    simulation, = simulate(iter(events), ["lru"], [1000], [0], sample=0.5)
+    assert 0 < simulation.reads < 10000
+    assert simulation.hit_rate > 0.9
@@ -0,0 +1,42 @@
+import json
+import zlib
+
+import pytest
+
+from compression import choose_encoding, write_compressed
+from metrics import Metrics
+
+
+@pytest.mark.parametrize("header,expected", [
+    (None, None),
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("deflate", "deflate"),
+    ("gzip, deflate, br", "gzip"),
+    ("gzip;q=0.5, deflate", "deflate"),
+    ("gzip;q=0, deflate;q=0", None),
+    ("*", "gzip"),
+    ("*;q=0.1, gzip;q=0", "deflate"),
+])
+def test_choose_encoding(header, expected):
+    assert expected == choose_encoding(header)
+
+
+@pytest.mark.parametrize("encoding,wbits", [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)])
+def test_write_compressed(encoding, wbits):
+    body = {"response": {str(i): ["books", "tv"] for i in range(1000)}, "code": 200}
+    written = []
+    metrics = Metrics()
+    write_compressed(written.append, json.dumps(body), encoding, metrics=metrics)
+    raw = zlib.decompress("".join(written), wbits)
+    assert body == json.loads(raw)
+    # output is written piece by piece
+    assert len(written) > 1
+
+    snapshot = metrics.snapshot()
+    assert 1 == snapshot["counters"]["compression.%s.responses" % encoding]
+    assert len(raw) == snapshot["counters"]["compression.bytes_in"]
+    assert len("".join(written)) == snapshot["counters"]["compression.bytes_out"]
+    assert snapshot["histograms"]["compression.ratio_percent"]["max"] < 100
+    assert 1 == snapshot["histograms"]["compression.time_ms"]["count"]
@@ -0,0 +1,59 @@
+import datetime
+
+import pytest
+
+import dates
+from dates import AgeCutoff, parse_date, parse_dates
+
+
+@pytest.mark.parametrize("value", [
+    "01.01.2000", "29.02.2016", "31.12.1999", "1.1.2000", "01.1.2000", u"07.07.2017",
+    "29.02.2017", "32.01.2000", "00.01.2000", "01.13.2000", "01.01.0000", "01-01-2000",
+    "01.01.20000", "01.01.200", " 1.01.2000", "a1.01.2000", "", u"\u0661\u0661.01.2000",
+])
+def test_parse_date_is_same_as_strptime(value):
+    try:
+        expected = datetime.datetime.strptime(value, "%d.%m.%Y")
+    except ValueError:
+        with pytest.raises(ValueError):
+            parse_date(value)
+    else:
+        assert expected == parse_date(value)
+        # the memoized value
+        assert expected == parse_date(value)
+
+
+def test_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(dates, "MEMO_SIZE", 10)
+    monkeypatch.setattr(dates, "_memo", {})
+    for day in range(1, 29):
+        parse_date("%02d.02.2000" % day)
+    assert len(dates._memo) <= 10
+
+
+def test_parse_dates():
+    assert [datetime.datetime(2000, 1, 2), None, None] == parse_dates(["02.01.2000", "30.02.2000", None])
+
+
+def test_age_cutoff_is_computed_once_per_day():
+    days = [datetime.date(2017, 7, 1)]
+    calls = []
+
+    def today():
+        calls.append(1)
+        return days[0]
+
+    cutoff = AgeCutoff(70, today=today)
+    first = cutoff()
+    assert datetime.datetime(1947, 7, 19) == first
+    assert first is cutoff()
+    days[0] += datetime.timedelta(days=1)
+    assert datetime.datetime(1947, 7, 20) == cutoff()
+    assert cutoff.is_too_old(datetime.datetime(1947, 7, 20))
+    assert not cutoff.is_too_old(datetime.datetime(1947, 7, 21))
+
+
+def test_validate_many_birthdays():
+    cutoff = AgeCutoff(70, today=lambda: datetime.date(2017, 7, 1))
+    assert [datetime.datetime(1990, 1, 1), None, None] == \
+        cutoff.validate_many(["01.01.1990", "01.01.1900", "1990-01-01"])
@@ -0,0 +1,53 @@
+import random
+
+from hotkeys import CountMinSketch, HeavyHitters
+
+
+def test_sketch_never_underestimates():
+    sketch = CountMinSketch(width=64, depth=4)
+    counts = {}
+    rnd = random.Random(1)
+    for _ in range(2000):
+        key = "uid:%d" % rnd.randint(0, 200)
+        counts[key] = counts.get(key, 0) + 1
+        sketch.add(key)
+    for key, count in counts.items():
+        assert sketch.estimate(key) >= count
+    assert 0 == CountMinSketch().estimate("unknown")
+
+
+def test_heavy_hitters_finds_frequent_keys():
+    tracker = HeavyHitters(size=3, decay_interval=0)
+    rnd = random.Random(2)
+    for _ in range(5000):
+        tracker.add("uid:%d" % rnd.randint(0, 1000))
+    for key, count in (("i:1", 500), ("i:2", 300), ("i:3", 200)):
+        for _ in range(count):
+            tracker.add(key)
+    top = tracker.most_common()
+    assert ["i:1", "i:2", "i:3"] == [key for key, _ in top]
+    assert top[0][1] >= 500
+    assert [("i:1", top[0][1])] == tracker.most_common(1)
+
+
+def test_heavy_hitters_decay(clock):
+    tracker = HeavyHitters(size=2, decay_interval=60, clock=clock)
+    tracker.add_many(["old"] * 8)
+    clock.now += 60
+    tracker.add("new")
+    assert [("old", 4), ("new", 1)] == tracker.most_common()
+    # two intervals and a half passed, counters are halved twice
+    clock.now += 150
+    tracker.add_many(["new"] * 4)
+    assert [("new", 4), ("old", 1)] == tracker.most_common()
+    clock.now += 30
+    tracker.add("new")
+    assert [("new", 3), ("old", 0)] == tracker.most_common()
+
+
+def test_heavy_hitters_sample():
+    tracker = HeavyHitters(size=2, decay_interval=0, sample=4)
+    tracker.add_many(["a"] * 400 + ["b"] * 40)
+    assert [("a", 400), ("b", 40)] == tracker.most_common()
+    tracker.add_many(["c"] * 3)
+    assert tracker.estimate("c") in (0, 4)
@@ -162,3 +162,84 @@ def test_online_score_broken_redis(data, expected, api_request, monkeypatch):
         resp = api_request(data).json()
         assert api.OK == resp.get("code")
         assert expected == resp.get("response")
+
+
+def test_api_ready():
+    resp = requests.get(API_URL.replace("/method", "/ready"))
+    assert api.OK == resp.status_code
+    assert {"ready": True} == resp.json().get("response")
+
+
+def test_api_metrics():
+    resp = requests.get(API_URL.replace("/method", "/metrics"))
+    assert api.OK == resp.status_code
+    assert {"counters", "histograms"} == set(resp.json().get("response"))
+
+
+def test_request_deadline_exceeded():
+    data = authorize_request({"account": "test_acc", "login": "test_login", "method": "online_score",
+                              "token": "", "arguments": {"phone": "71234567890", "email": "john@example.com"}})
+    resp = requests.post(API_URL, json=data, headers={"X-Request-Timeout": "0"}).json()
+    assert api.GATEWAY_TIMEOUT == resp.get("code")
+    resp = requests.post(API_URL, json=data, headers={"X-Request-Timeout": "1000"}).json()
+    assert api.OK == resp.get("code")
+
+
+def test_clients_interests_etag():
+    data = authorize_request({"account": "test_acc", "login": "test_login", "method": "clients_interests",
+                              "token": "", "arguments": {"client_ids": [1, 2]}})
+    with redis_set_data({"i:1": json.dumps(["books"]), "i:2": json.dumps(["tv"])}) as redis_store:
+        resp = requests.post(API_URL, json=data)
+        etag = resp.headers["ETag"]
+        assert api.OK == resp.status_code
+
+        resp = requests.post(API_URL, json=data, headers={"If-None-Match": 'W/"other", %s' % etag})
+        assert api.NOT_MODIFIED == resp.status_code
+        assert "" == resp.text
+        assert etag == resp.headers["ETag"]
+
+        redis_store.set("i:2", json.dumps(["tv", "pets"]))
+        resp = requests.post(API_URL, json=data, headers={"If-None-Match": etag})
+        assert api.OK == resp.status_code
+        assert etag != resp.headers["ETag"]
+        assert {"1": ["books"], "2": ["tv", "pets"]} == resp.json().get("response")
+
+
+def test_large_response_is_compressed():
+    client_ids = range(1, 301)
+    data = authorize_request({"account": "test_acc", "login": "test_login", "method": "clients_interests",
+                              "token": "", "arguments": {"client_ids": client_ids}})
+    resp = requests.post(API_URL, json=data, headers={"Accept-Encoding": "gzip"})
+    assert api.OK == resp.status_code
+    assert "gzip" == resp.headers.get("Content-Encoding")
+    assert len(client_ids) == len(resp.json().get("response"))
+
+    resp = requests.post(API_URL, json=data, headers={"Accept-Encoding": "identity"})
+    assert resp.headers.get("Content-Encoding") is None
+    assert len(client_ids) == len(resp.json().get("response"))
+
+
+def test_small_response_is_not_compressed(api_request):
+    resp = api_request({})
+    assert resp.headers.get("Content-Encoding") is None
+
+
+def test_admin_hotkeys():
+    url = API_URL.replace("/method", "/admin/hotkeys")
+    assert api.FORBIDDEN == requests.get(url).status_code
+    assert api.FORBIDDEN == requests.get(url, headers={"X-Admin-Token": "wrong"}).status_code
+
+    # one of 16 keys read from the store is counted
+    client_ids = range(1000, 1032)
+    data = authorize_request({"account": "hot_acc", "login": "hot_login", "method": "clients_interests",
+                              "token": "", "arguments": {"client_ids": client_ids}})
+    requests.post(API_URL, json=data)
+    forged = dict(data, login="forged_login")
+    assert api.FORBIDDEN == requests.post(API_URL, json=forged).status_code
+    resp = requests.get(url, headers={"X-Admin-Token": api.admin_token()})
+    assert api.OK == resp.status_code
+    response = resp.json().get("response")
+    assert "hot_acc/hot_login" in dict(response["callers"])
+    assert "hot_acc/forged_login" not in dict(response["callers"])
+    assert "ip:127.0.0.1" in dict(response["callers"])
+    assert set("i:%d" % i for i in client_ids) & set(dict(response["keys"]))
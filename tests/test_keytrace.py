@@ -0,0 +1,48 @@
+import pytest
+
+from keytrace import TraceWriter, read_trace, READ, WRITE, DELETE
+
+
+@pytest.fixture
+def trace_path(tmpdir):
+    return str(tmpdir.join("trace.bin"))
+
+
+def test_write_and_read_trace(trace_path, clock):
+    writer = TraceWriter(trace_path, buffer_size=10, clock=clock)
+    writer.record("uid:1")
+    clock.now += 1.5
+    writer.record_many([u"i:1", "i:2"], WRITE)
+    writer.record("uid:1", DELETE)
+    writer.close()
+    assert [(1000, READ, "uid:1"), (1001, WRITE, "i:1"), (1001, WRITE, "i:2"), (1001, DELETE, "uid:1")] == \
+        list(read_trace(trace_path))
+
+
+def test_trace_is_appended(trace_path):
+    for key in ("uid:1", "uid:2"):
+        writer = TraceWriter(trace_path)
+        writer.record(key)
+        writer.close()
+    assert ["uid:1", "uid:2"] == [key for _, _, key in read_trace(trace_path)]
+
+
+def test_read_trace_in_small_chunks_skips_incomplete_record(trace_path):
+    writer = TraceWriter(trace_path)
+    writer.record_many(["uid:%d" % i for i in range(100)])
+    writer.close()
+    with open(trace_path, "ab") as f:
+        f.write("\x00\x01")
+    keys = [key for _, _, key in read_trace(trace_path, chunk_size=7)]
+    assert ["uid:%d" % i for i in range(100)] == keys
+
+
+def test_store_records_trace(resp_server, trace_path, make_store):
+    store = make_store(resp_server, TRACE_PATH=trace_path)
+    store.cache_set("uid:1", 1.5, 60)
+    store.cache_get("uid:1")
+    store.get_many(["i:1", "i:2"])
+    store.delete("uid:1")
+    store.trace.close()
+    assert [(WRITE, "uid:1"), (READ, "uid:1"), (READ, "i:1"), (READ, "i:2"), (DELETE, "uid:1")] == \
+        [(op, key) for _, op, key in read_trace(trace_path)]
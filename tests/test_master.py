@@ -0,0 +1,67 @@
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from master import Master
+
+
+@pytest.fixture
+def master():
+    master = Master(("127.0.0.1", 0), workers=2, start_delay=0, drain_timeout=5).listen().start()
+    yield master
+    if master.workers:
+        master.stop()
+
+
+def ready_url(master):
+    return "http://%s:%s/ready" % master.address
+
+
+def test_reload_replaces_workers_without_errors(master):
+    assert 200 == requests.get(ready_url(master)).status_code
+    old_workers = list(master.workers)
+    errors = []
+    done = threading.Event()
+
+    def send_requests():
+        while not done.is_set():
+            try:
+                if requests.get(ready_url(master), timeout=5).status_code != 200:
+                    errors.append("bad status")
+            except requests.RequestException as e:
+                errors.append(e)
+
+    client = threading.Thread(target=send_requests)
+    client.start()
+    try:
+        assert master.reload()
+    finally:
+        done.set()
+        client.join()
+    assert [] == errors
+    assert 2 == len(master.workers)
+    assert not set(worker.pid for worker in old_workers) & set(worker.pid for worker in master.workers)
+    for worker in old_workers:
+        assert 0 == worker.process.wait()
+    master.check_workers()
+    assert [] == master.stopping
+
+
+def test_stopped_worker_finishes_request_in_progress(master):
+    conn = socket.create_connection(master.address)
+    conn.sendall("GET /ready HTTP/1.0\r\n")
+    time.sleep(0.2)
+    stopping = threading.Thread(target=master.stop)
+    stopping.start()
+    time.sleep(0.5)
+    # workers wait for the request instead of exiting
+    assert master.stopping
+    conn.sendall("\r\n")
+    response = conn.recv(1024)
+    conn.close()
+    stopping.join()
+    assert response.startswith("HTTP/1.0 200")
+    assert [] == master.stopping
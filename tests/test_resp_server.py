@@ -0,0 +1,70 @@
+import pytest
+import redis
+
+from resp_server import FaultPlan, constant
+
+
+def test_get_set_delete(resp_server, make_store):
+    store = make_store(resp_server)
+    store.set("key", "42")
+    assert "42" == store.get("key")
+    store.delete("key")
+    assert store.get("key") is None
+
+
+def test_cache_set_expiration(resp_server, clock, make_store):
+    store = make_store(resp_server)
+    store.cache_set("key", 42, 60)
+    assert "42" == store.cache_get("key")
+    clock.now += 61
+    assert store.cache_get("key") is None
+
+
+def test_pipeline_and_mget(resp_server, make_store):
+    store = make_store(resp_server).connect()
+    pipe = store.conn.pipeline()
+    pipe.set("a", 1).set("b", 2, ex=10).get("a")
+    assert [True, True, "1"] == pipe.execute()
+    assert ["1", "2", None] == store.conn.mget(["a", "b", "c"])
+
+
+def test_slow_backend_timeout(resp_server, make_store):
+    store = make_store(resp_server)
+    store.set("key", "42")
+    resp_server.faults = FaultPlan(latency={"GET": constant(0.5)})
+    assert store.cache_get("key") is None
+    with pytest.raises(redis.TimeoutError):
+        store.get("key")
+
+
+def test_dropped_reply(resp_server, make_store):
+    store = make_store(resp_server).connect()
+    resp_server.faults = FaultPlan(drop={"SET": 1})
+    store.cache_set("key", 42, 60)
+    resp_server.faults = FaultPlan()
+    # the command was executed but reply was never sent
+    assert "42" == store.cache_get("key")
+
+
+def test_disconnect_and_reconnect(resp_server, make_store):
+    store = make_store(resp_server)
+    store.set("key", "42")
+    resp_server.faults = FaultPlan(disconnect={"GET": 1})
+    assert store.cache_get("key") is None
+    resp_server.faults = FaultPlan()
+    assert "42" == store.cache_get("key")
+
+
+def test_connection_attempts(resp_server, make_store):
+    resp_server.faults = FaultPlan(disconnect={"PING": 1})
+    store = make_store(resp_server, ATTEMPTS=2)
+    store.cache_get("key")
+    # initial ping plus 2 attempts, redis-py retries each command once on disconnect
+    assert 3 * 2 == resp_server.stats["PING"]
+    assert 1 == resp_server.stats["GET"]
+
+
+def test_faults_are_deterministic():
+    plan_a = FaultPlan(drop={"*": 0.5}, seed=7)
+    plan_b = FaultPlan(drop={"*": 0.5}, seed=7)
+    assert [plan_a.decide("GET") for _ in range(20)] == [plan_b.decide("GET") for _ in range(20)]
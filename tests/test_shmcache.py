@@ -0,0 +1,123 @@
+import os
+import pytest
+
+from shmcache import SharedMemoryCache, TieredCache, VALUE_SIZE, WAYS
+
+
+class CountingStore(object):
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.calls = 0
+
+    def get(self, key, deadline=None):
+        self.calls += 1
+        return self.data.get(key)
+
+    def get_many(self, keys, deadline=None):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    cache_get = get
+    cache_get_many = get_many
+
+    def cache_set(self, key, value, expired=None, deadline=None):
+        self.data[key] = str(value)
+
+
+@pytest.fixture
+def shm_path(tmpdir):
+    return str(tmpdir.join("cache.shm"))
+
+
+@pytest.fixture
+def shm_cache(shm_path, clock):
+    cache = SharedMemoryCache(shm_path, buckets=16, clock=clock)
+    yield cache
+    cache.close()
+
+
+def test_set_get_delete(shm_cache):
+    assert shm_cache.get("uid:1") is None
+    assert shm_cache.set("uid:1", 3.0)
+    assert "3.0" == shm_cache.get("uid:1")
+    assert shm_cache.set(u"i:1", u'["books"]')
+    assert '["books"]' == shm_cache.get("i:1")
+    shm_cache.delete("uid:1")
+    assert shm_cache.get("uid:1") is None
+
+
+def test_expiration(shm_cache, clock):
+    shm_cache.set("uid:1", "1.5", ttl=10)
+    clock.now += 9
+    assert "1.5" == shm_cache.get("uid:1")
+    clock.now += 1
+    assert shm_cache.get("uid:1") is None
+
+
+def test_too_big_value_is_not_cached(shm_cache):
+    shm_cache.set("i:1", "[]")
+    assert not shm_cache.set("i:1", "x" * (VALUE_SIZE + 1))
+    assert shm_cache.get("i:1") is None
+
+
+def test_clock_eviction_keeps_referenced_keys(shm_path, clock):
+    cache = SharedMemoryCache(shm_path, buckets=1, clock=clock)
+    keys = ["uid:%d" % i for i in range(WAYS)]
+    for key in keys:
+        cache.set(key, key)
+    # reference bits of all keys are cleared by the first eviction
+    cache.set("uid:new1", "new1")
+    assert cache.get(keys[0]) is None
+    cache.get(keys[1])
+    cache.set("uid:new2", "new2")
+    assert keys[1] == cache.get(keys[1])
+    assert cache.get(keys[2]) is None
+    cache.close()
+
+
+def test_cache_is_shared_between_processes(shm_cache, shm_path):
+    pid = os.fork()
+    if pid == 0:
+        child_cache = SharedMemoryCache(shm_path, buckets=16)
+        child_cache.set("uid:child", "from child")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert "from child" == shm_cache.get("uid:child")
+
+
+def test_new_layout_doesnt_break_processes_of_old_one(shm_path):
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        cache = SharedMemoryCache(shm_path, buckets=64)
+        cache.set("uid:1", "old")
+        os.write(ready_w, "1")
+        os.read(go_r, 1)
+        os._exit(0 if cache.get("uid:1") == "old" else 1)
+    os.read(ready_r, 1)
+    cache = SharedMemoryCache(shm_path, buckets=16)
+    cache.set("uid:2", "new")
+    os.write(go_w, "1")
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and 0 == os.WEXITSTATUS(status)
+    assert cache.get("uid:1") is None
+    cache.close()
+    cache = SharedMemoryCache(shm_path, buckets=16)
+    assert "new" == cache.get("uid:2")
+    cache.close()
+    for fd in (ready_r, ready_w, go_r, go_w):
+        os.close(fd)
+
+
+def test_tiered_cache_serves_hot_keys_from_shared_memory(shm_cache):
+    store = CountingStore({"i:1": '["books"]', "i:2": '["tv"]'})
+    cache = TieredCache(shm_cache, store)
+    assert '["books"]' == cache.get("i:1")
+    assert '["books"]' == cache.get("i:1")
+    assert 1 == store.calls
+    assert ['["books"]', '["tv"]', None] == cache.get_many(["i:1", "i:2", "i:3"])
+    assert 2 == store.calls
+    cache.cache_set("uid:1", 3.0, 60 * 60)
+    assert "3.0" == cache.cache_get("uid:1")
+    assert 2 == store.calls
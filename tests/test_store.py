@@ -1,10 +1,12 @@
 import pytest
+import threading
 import uuid
 import time
 
 import redis
 
-from store import RedisCache, REDIS_CONFIG
+from resp_server import RespServer, FaultPlan, constant
+from store import RedisCache, HashRing, REDIS_CONFIG, DeadlineExceeded
 
 REDIS_BAD_CONFIG = {
     "HOST": "wrong_host",
@@ -60,3 +62,251 @@ def test_save_value_with_expiration(redis_store):
     assert redis_store.get("test_key_with_expiration2") == str(42)
     assert redis_store.get("test_key_with_expiration3") is None
     redis_store.delete("test_key_with_expiration2")
+
+
+@pytest.fixture
+def resp_servers():
+    servers = [RespServer().start() for _ in range(3)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def make_sharded_store(servers, **config):
+    sharded_config = dict(REDIS_CONFIG, SLEEP_TIMEOUT=0, SOCKET_TIMEOUT=0.2,
+                          NODES=[{"HOST": "127.0.0.1", "PORT": server.port} for server in servers])
+    sharded_config.update(config)
+    return RedisCache(config=sharded_config)
+
+
+def test_hash_ring_moves_only_keys_of_new_node():
+    ring = HashRing(["node1", "node2", "node3"])
+    keys = ["uid:%d" % i for i in range(3000)]
+    before = {key: ring.get_node(key) for key in keys}
+    ring.add_node("node4")
+    moved = [key for key in keys if ring.get_node(key) != before[key]]
+    assert all(ring.get_node(key) == "node4" for key in moved)
+    assert 0.15 < len(moved) / float(len(keys)) < 0.35
+
+
+def test_sharded_store_spreads_keys(resp_servers):
+    store = make_sharded_store(resp_servers)
+    keys = ["i:%d" % i for i in range(60)]
+    for key in keys:
+        store.set(key, key)
+    assert all(server.storage.data for server in resp_servers)
+    assert sum(len(server.storage.data) for server in resp_servers) == len(keys)
+    assert keys + [None] == store.get_many(keys + ["i:missing"])
+    assert all(server.stats["MGET"] == 1 for server in resp_servers)
+
+
+def test_sharded_store_with_node_down(resp_servers):
+    store = make_sharded_store(resp_servers, FAILURE_THRESHOLD=1)
+    keys = ["uid:%d" % i for i in range(30)]
+    for key in keys:
+        store.cache_set(key, key, 60)
+    broken = resp_servers[0]
+    broken.faults = FaultPlan(disconnect={"*": 1})
+    values = store.cache_get_many(keys)
+    for key, value in zip(keys, values):
+        assert value == (None if key in broken.storage.data else key)
+    # the node is down so commands are not sent to it
+    mget_calls = broken.stats["MGET"]
+    store.cache_get_many(keys)
+    assert mget_calls == broken.stats["MGET"]
+    with pytest.raises(redis.ConnectionError):
+        store.get_many(keys)
+
+
+def test_sharded_store_add_node(resp_servers):
+    store = make_sharded_store(resp_servers[:2])
+    keys = ["uid:%d" % i for i in range(30)]
+    store.add_node({"HOST": "127.0.0.1", "PORT": resp_servers[2].port})
+    for key in keys:
+        store.set(key, key)
+    assert resp_servers[2].storage.data
+    assert keys == store.get_many(keys)
+
+
+@pytest.fixture
+def make_replicated_store(make_store):
+    def make(primary, replicas, **config):
+        replica_nodes = [{"HOST": "127.0.0.1", "PORT": server.port} for server in replicas]
+        return make_store(primary, REPLICAS=replica_nodes, **config)
+    return make
+
+
+def emulate_replica(server, lag=0, link_status="up"):
+    server.storage.replication = {"role": "slave", "master_link_status": link_status,
+                                  "master_last_io_seconds_ago": lag}
+
+
+def test_reads_go_to_replica(resp_servers, make_replicated_store):
+    primary, replica = resp_servers[:2]
+    emulate_replica(replica)
+    store = make_replicated_store(primary, [replica])
+    store.set("key", "primary")
+    store.cache_set("uid:1", "primary", 60)
+    replica.storage.set("key", "replica")
+    assert "replica" == store.get("key")
+    assert [None] == store.get_many(["uid:1"])
+    assert 2 == primary.stats["SET"]
+    assert 0 == primary.stats["GET"] + primary.stats["MGET"]
+
+
+def test_reads_fall_back_to_primary(resp_servers, make_replicated_store):
+    primary, replica = resp_servers[:2]
+    store = make_replicated_store(primary, [replica], REPLICA_CHECK_INTERVAL=0)
+    primary.storage.set("key", "primary")
+
+    emulate_replica(replica, lag=60)
+    assert "primary" == store.cache_get("key")
+    emulate_replica(replica, link_status="down")
+    assert "primary" == store.cache_get("key")
+    emulate_replica(replica)
+    replica.faults = FaultPlan(disconnect={"GET": 1})
+    assert "primary" == store.cache_get("key")
+    assert 3 == primary.stats["GET"]
+
+
+def test_reads_prefer_fast_replica(resp_servers, make_replicated_store):
+    primary, fast, slow = resp_servers
+    for server in (fast, slow):
+        emulate_replica(server)
+    slow.faults = FaultPlan(latency={"GET": constant(0.02)})
+    store = make_replicated_store(primary, [fast, slow])
+    for _ in range(20):
+        store.get("key")
+    assert 0 == primary.stats["GET"]
+    assert slow.stats["GET"] <= 2 < fast.stats["GET"]
+
+
+def read_concurrently(func, keys):
+    results = {}
+
+    def read(key):
+        try:
+            results[key] = func(key)
+        except redis.RedisError as e:
+            results[key] = e
+
+    threads = [threading.Thread(target=read, args=(key,)) for key in keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_reads_are_batched(resp_servers, make_store):
+    server = resp_servers[0]
+    store = make_store(server, BATCH_WINDOW=0.1)
+    keys = ["uid:%d" % i for i in range(10)]
+    for key in keys[:5]:
+        server.storage.set(key, key)
+    results = read_concurrently(store.cache_get, keys + keys[:3])
+    assert {key: key if key in keys[:5] else None for key in keys} == results
+    assert 1 == server.stats["MGET"]
+    assert 0 == server.stats["GET"]
+
+
+def test_full_batch_is_sent_before_window(resp_servers, make_store):
+    server = resp_servers[0]
+    store = make_store(server, BATCH_WINDOW=10, BATCH_MAX_KEYS=4)
+    started = time.time()
+    results = read_concurrently(store.get, ["i:%d" % i for i in range(4)])
+    assert time.time() - started < 1
+    assert set(results.values()) == {None}
+    assert 1 == server.stats["MGET"]
+
+
+def test_batch_error_is_raised_in_every_reader(resp_servers, make_store):
+    server = resp_servers[0]
+    server.faults = FaultPlan(disconnect={"MGET": 1})
+    store = make_store(server, BATCH_WINDOW=0.1)
+    keys = ["i:%d" % i for i in range(3)]
+    assert all(isinstance(error, redis.ConnectionError)
+               for error in read_concurrently(store.get, keys).values())
+    assert {key: None for key in keys} == read_concurrently(store.cache_get, keys)
+
+
+def test_slow_node_doesnt_hold_reads_of_other_requests(resp_servers):
+    store = make_sharded_store(resp_servers[:2], SOCKET_TIMEOUT=5)
+    keys = ["uid:%d" % i for i in range(30)]
+    for key in keys:
+        store.set(key, key)
+    assert keys == store.get_many(keys)
+    resp_servers[0].faults = FaultPlan(latency={"MGET": constant(0.5)})
+    slow_reads = [threading.Thread(target=store.get_many, args=(keys,)) for _ in range(4)]
+    for thread in slow_reads:
+        thread.start()
+    time.sleep(0.05)
+    started = time.time()
+    with pytest.raises(DeadlineExceeded):
+        store.get_many(keys, deadline=time.time() + 0.1)
+    assert time.time() - started < 0.3
+    fast_keys = [key for key in keys if store.ring.get_node(key) != store.default_node]
+    assert fast_keys == store.get_many(fast_keys)
+    for thread in slow_reads:
+        thread.join()
+
+
+def test_deadline_limits_slow_command(resp_server, make_store):
+    store = make_store(resp_server, SOCKET_TIMEOUT=5)
+    store.set("key", "42")
+    resp_server.faults = FaultPlan(latency={"GET": constant(0.5)})
+    started = time.time()
+    with pytest.raises(DeadlineExceeded):
+        store.cache_get("key", deadline=time.time() + 0.1)
+    assert time.time() - started < 0.4
+    # timeout caused by deadline doesn't mark the node as failed
+    assert 0 == store.health[store.default_node].failures
+
+
+def test_expired_deadline_skips_backend(resp_server, make_store):
+    store = make_store(resp_server)
+    with pytest.raises(DeadlineExceeded):
+        store.get("key", deadline=time.time() - 1)
+    assert 0 == resp_server.stats["GET"]
+
+
+def test_deadline_while_waiting_for_batch(resp_server, make_store):
+    resp_server.faults = FaultPlan(latency={"MGET": constant(0.5)})
+    store = make_store(resp_server, SOCKET_TIMEOUT=5, BATCH_WINDOW=0.01)
+    errors = []
+
+    def read(deadline):
+        try:
+            store.cache_get("key", deadline=deadline)
+        except DeadlineExceeded as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=read, args=(None,))
+    leader.start()
+    time.sleep(0.005)
+    started = time.time()
+    read(time.time() + 0.1)
+    assert time.time() - started < 0.4
+    assert 1 == len(errors)
+    leader.join()
+
+
+def test_expired_deadline_of_batch_leader_doesnt_block_next_reads(resp_server, make_store):
+    store = make_store(resp_server, BATCH_WINDOW=0.01)
+    store.set("uid:2", "2")
+    with pytest.raises(DeadlineExceeded):
+        store.cache_get("uid:1", deadline=time.time() - 1)
+    started = time.time()
+    assert "2" == store.cache_get("uid:2")
+    assert "2" == store.get("uid:2", deadline=time.time() + 1)
+    assert time.time() - started < 0.5
+
+
+def test_deadline_limits_retry_of_command(resp_server, make_store):
+    store = make_store(resp_server, SOCKET_TIMEOUT=5)
+    resp_server.faults = FaultPlan(latency={"GET": constant(0.09)}, disconnect={"GET": 1})
+    started = time.time()
+    with pytest.raises(DeadlineExceeded):
+        store.get("key", deadline=time.time() + 0.1)
+    # redis-py retries the command after disconnect within the same deadline
+    assert time.time() - started < 0.15
@@ -0,0 +1,111 @@
+import os
+import pytest
+
+from shmcache import SharedMemoryCache
+from warmup import write_snapshot, load_snapshot, scan_warm_up, warm_up, SnapshotWriter
+
+
+@pytest.fixture
+def l1_factory(tmpdir, clock):
+    caches = []
+
+    def make_l1(name):
+        cache = SharedMemoryCache(str(tmpdir.join(name)), buckets=16, clock=clock)
+        caches.append(cache)
+        return cache
+    yield make_l1
+    for cache in caches:
+        cache.close()
+
+
+def test_snapshot_keeps_the_hottest_values(l1_factory, tmpdir, clock):
+    l1 = l1_factory("old.shm")
+    for i in range(5):
+        l1.set("uid:%d" % i, str(i), ttl=100)
+        for _ in range(i):
+            l1.get("uid:%d" % i)
+    path = str(tmpdir.join("snapshot"))
+    assert 3 == write_snapshot(l1, path, limit=3)
+
+    clock.now += 50
+    new_l1 = l1_factory("new.shm")
+    assert 3 == load_snapshot(new_l1, path)
+    assert [None, None, "2", "3", "4"] == [new_l1.get("uid:%d" % i) for i in range(5)]
+    clock.now += 50
+    assert new_l1.get("uid:4") is None
+
+
+def test_expired_values_are_not_loaded(l1_factory, tmpdir, clock):
+    l1 = l1_factory("old.shm")
+    l1.set("uid:1", "1", ttl=10)
+    path = str(tmpdir.join("snapshot"))
+    write_snapshot(l1, path)
+    clock.now += 10
+    assert 0 == load_snapshot(l1_factory("new.shm"), path)
+
+
+def test_snapshot_keeps_any_bytes(l1_factory, tmpdir):
+    l1 = l1_factory("old.shm")
+    l1.set("uid:\xff", "\xfe\x00", ttl=100)
+    l1.set(u"i:\u0431", u'["\u043a\u043d\u0438\u0433\u0438"]', ttl=100)
+    path = str(tmpdir.join("snapshot"))
+    assert 2 == write_snapshot(l1, path)
+    new_l1 = l1_factory("new.shm")
+    assert 2 == load_snapshot(new_l1, path)
+    assert "\xfe\x00" == new_l1.get("uid:\xff")
+    assert u'["\u043a\u043d\u0438\u0433\u0438"]'.encode("utf-8") == new_l1.get(u"i:\u0431")
+
+
+def test_only_one_process_writes_snapshot(l1_factory, tmpdir):
+    l1 = l1_factory("cache.shm")
+    l1.set("uid:1", "1", ttl=100)
+    path = str(tmpdir.join("snapshot"))
+    locked_r, locked_w = os.pipe()
+    stop_r, stop_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        writer = SnapshotWriter(l1, path)
+        writer.write()
+        os.write(locked_w, "1")
+        os.read(stop_r, 1)
+        writer.stop()
+        os._exit(0)
+    os.read(locked_r, 1)
+    writer = SnapshotWriter(l1, path)
+    assert not writer.write()
+    # the writer is stopped and another process takes over
+    os.write(stop_w, "1")
+    os.waitpid(pid, 0)
+    assert writer.write()
+    writer.stop()
+    assert 1 == load_snapshot(l1_factory("new.shm"), path)
+    assert [] == [name for name in os.listdir(str(tmpdir)) if name.endswith(".tmp")]
+    for fd in (locked_r, locked_w, stop_r, stop_w):
+        os.close(fd)
+
+
+def test_scan_warm_up(l1_factory, resp_server, make_store):
+    for i in range(10):
+        resp_server.storage.set("uid:%d" % i, str(i))
+        resp_server.storage.set("i:%d" % i, "[]")
+        resp_server.storage.set("other:%d" % i, "x")
+    store = make_store(resp_server)
+    l1 = l1_factory("cache.shm")
+    assert 15 == scan_warm_up(store, l1, ttl=60, limit=15)
+    assert "9" == l1.get("uid:9")
+    assert l1.get("other:1") is None
+
+
+def test_warm_up_prefers_snapshot(l1_factory, resp_server, tmpdir, make_store):
+    resp_server.storage.set("uid:1", "1")
+    store = make_store(resp_server)
+    path = str(tmpdir.join("snapshot"))
+    assert 1 == warm_up(store, l1_factory("scan.shm"), 60, path)
+    assert resp_server.stats["SCAN"]
+
+    l1 = l1_factory("snapshot.shm")
+    l1.set("uid:2", "2")
+    write_snapshot(l1, path)
+    scans = resp_server.stats["SCAN"]
+    assert 1 == warm_up(store, l1_factory("new.shm"), 60, path)
+    assert scans == resp_server.stats["SCAN"]
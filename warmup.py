@@ -0,0 +1,139 @@
+import base64
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_SNAPSHOT_SIZE = 10000
+DEFAULT_SNAPSHOT_INTERVAL = 60   # in seconds
+DEFAULT_SCAN_LIMIT = 10000
+WARMUP_PATTERNS = ("uid:*", "i:*")
+
+
+def write_snapshot(l1, path, limit=DEFAULT_SNAPSHOT_SIZE):
+    """
+    Save `limit` values of shared memory cache with the most hits
+    as json lines, the file is replaced atomically. Keys and values
+    are any bytes so they are encoded with base64
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    count = 0
+    try:
+        with open(tmp_path, "w") as f:
+            for key, value, expires_at, hits in l1.hottest(limit):
+                f.write(json.dumps({"key64": base64.b64encode(key), "value64": base64.b64encode(value),
+                                    "expires_at": expires_at}) + "\n")
+                count += 1
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+def load_snapshot(l1, path):
+    """ Put values from snapshot to shared memory cache, returns number of loaded values """
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    now = l1.clock()
+    with open(path) as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+                key, value = base64.b64decode(item["key64"]), base64.b64decode(item["value64"])
+                ttl = item["expires_at"] - now
+            except (ValueError, TypeError, KeyError):
+                logging.error("Broken line in cache snapshot %s", path)
+                continue
+            if ttl > 0 and l1.set(key, value, ttl):
+                count += 1
+    return count
+
+
+def scan_warm_up(store, l1, ttl, limit=DEFAULT_SCAN_LIMIT, patterns=WARMUP_PATTERNS):
+    """ Put up to `limit` values of keys matching `patterns` from Redis to shared memory cache """
+    count = 0
+    for pattern in patterns:
+        keys = store.scan(pattern, limit - count)
+        if not keys:
+            continue
+        for key, value in zip(keys, store.cache_get_many(keys)):
+            if value is not None and l1.set(key, value, ttl):
+                count += 1
+    return count
+
+
+def warm_up(store, l1, ttl, snapshot_path=None, scan_limit=DEFAULT_SCAN_LIMIT):
+    """
+    Fill shared memory cache before serving requests:
+    from snapshot if it exists or with bounded SCAN of Redis
+    """
+    started = time.time()
+    count = load_snapshot(l1, snapshot_path) if snapshot_path else 0
+    source = "snapshot"
+    if not count and scan_limit:
+        count = scan_warm_up(store, l1, ttl, scan_limit)
+        source = "scan"
+    logging.info("Warmed up cache with %d values from %s in %.3f seconds",
+                 count, source, time.time() - started)
+    return count
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Writes snapshot of the hottest values every `interval` seconds and on stop.
+    All workers on the host share the cache, so only the one holding lock
+    of `path` + ".lock" writes it, another one takes over when it stops.
+    """
+    def __init__(self, l1, path, interval=DEFAULT_SNAPSHOT_INTERVAL, limit=DEFAULT_SNAPSHOT_SIZE):
+        super(SnapshotWriter, self).__init__()
+        self.daemon = True
+        self.l1 = l1
+        self.path = path
+        self.interval = interval
+        self.limit = limit
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.lock_fd = None
+
+    def _acquire(self):
+        """ Return True if this process writes the snapshot """
+        if self.lock_fd is None:
+            fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                os.close(fd)
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return False
+                raise
+            self.lock_fd = fd
+        return True
+
+    def write(self):
+        """ Write snapshot if this process is the writer, errors are logged """
+        with self.lock:
+            try:
+                if self._acquire():
+                    write_snapshot(self.l1, self.path, self.limit)
+                    return True
+            except Exception as e:
+                logging.exception("Error on writing cache snapshot %s: %s", self.path, e)
+            return False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+        with self.lock:
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None